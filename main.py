@@ -14,39 +14,50 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from __future__ import annotations
+
 import asyncio
+import contextvars
 import csv
+import gzip
+import heapq
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import IntEnum
+import html
 import json
 import logging
+import multiprocessing
 import os
+import queue
 import random
 import re
+import signal
+import tempfile
 import uuid
 import textwrap
-from datetime import datetime
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from pathlib import Path
-from time import sleep
-from logging.handlers import RotatingFileHandler
-from typing import List
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from multiprocessing.managers import SyncManager
+from typing import List, TYPE_CHECKING
 from argparse import ArgumentParser
 
+import httpx
 import requests
-from bs4 import BeautifulSoup
-from pyowm import OWM
-from pyowm.utils import config as OWMConfig
-from pyowm.weatherapi25.weather import Weather
-from pixivpy3 import AppPixivAPI
-from pixivpy3.utils import JsonDict
 from telegram import (
+    Bot,
     Update,
     InlineQueryResultArticle,
     InlineQueryResultPhoto,
+    InlineQueryResultCachedPhoto,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     InputTextMessageContent,
     InputMediaPhoto,
     Message,
+    CallbackQuery,
     User
   )
 from telegram.ext import (
@@ -55,15 +66,26 @@ from telegram.ext import (
   CommandHandler,
   MessageHandler,
   InlineQueryHandler,
+  ChosenInlineResultHandler,
   filters,
   CallbackQueryHandler,
   ContextTypes
 )
 from telegram.constants import ParseMode
+from telegram.error import TelegramError, RetryAfter
 from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 import shortuuid
 
+# pyowm and pixivpy3 are slow to import, they are imported on first use
+if TYPE_CHECKING:
+  from pyowm import OWM
+  from pyowm.weatherapi25.weather import Weather
+  from pyowm.weatherapi25.weather_manager import WeatherManager
+  from pixivpy3 import AppPixivAPI
+  from pixivpy3.utils import JsonDict
+
 # Load environment variable from .env file
 load_dotenv()
 
@@ -71,25 +93,89 @@ load_dotenv()
 bot_id = os.getenv("TG_BOT_ID")
 bot_pic_url = os.getenv("TG_BOT_PIC_URL")
 should_log_pixiv_query = int(os.getenv("LOG_PIXIV_QUERY") or "1")
+# Log line format, "text" or "json" (one JSON object per line)
+log_format = os.getenv("LOG_FORMAT") or "text"
+log_datefmt = "%Y-%m-%dT%H:%M:%S%z"
+# Number of rotated log files kept
+log_backup_count = 2
+# Chat for uploading delivered Pixiv illustrations to obtain their file_id, disabled if unset
+pixiv_cache_chat_id = os.getenv("PIXIV_CACHE_CHAT_ID")
+# Number of pages before and after the shown page of multi-page illustration to prefetch
+pixiv_prefetch_depth = int(os.getenv("PIXIV_PREFETCH_DEPTH") or "1")
+# Local Bot API server (e.g. http://localhost:8081) instead of api.telegram.org, if set
+tg_api_base_url = os.getenv("TG_BOT_API_BASE_URL")
+# Connection pool of outbound Bot API calls, and of polling updates
+tg_connection_pool_size = int(os.getenv("TG_CONNECTION_POOL_SIZE") or "64")
+tg_polling_pool_size = int(os.getenv("TG_POLLING_POOL_SIZE") or "2")
+# HTTP version ("1.1" or "2") of Bot API calls, HTTP/2 requires `pip install "python-telegram-bot[http2]"`
+tg_http_version = os.getenv("TG_HTTP_VERSION") or "1.1"
+# Timeouts (in seconds) of Bot API calls, and of idle connections kept alive
+tg_connect_timeout = float(os.getenv("TG_CONNECT_TIMEOUT") or "5")
+tg_read_timeout = float(os.getenv("TG_READ_TIMEOUT") or "10")
+tg_write_timeout = float(os.getenv("TG_WRITE_TIMEOUT") or "20")
+tg_pool_timeout = float(os.getenv("TG_POOL_TIMEOUT") or "5")
+tg_keepalive_expiry = float(os.getenv("TG_KEEPALIVE_EXPIRY") or "30")
+# Timeout (in seconds) of long polling
+tg_polling_timeout = int(os.getenv("TG_POLLING_TIMEOUT") or "30")
+# Delay (in seconds) before processing inline query, superseded query within this window costs nothing
+inline_debounce_delay = float(os.getenv("INLINE_DEBOUNCE_DELAY") or "0")
+# Time budget (in seconds) of upstream work for each inline query, Telegram discards answer arriving too late
+inline_query_deadline = float(os.getenv("INLINE_QUERY_DEADLINE") or "8")
+# Request rate (requests per second) and burst size of inline queries and callbacks of each user
+user_rate_limit = float(os.getenv("USER_RATE_LIMIT") or "2")
+user_rate_burst = int(os.getenv("USER_RATE_BURST") or "10")
+# Maximum inline queries and callbacks being processed, new requests are shed beyond this
+max_in_flight_requests = int(os.getenv("MAX_IN_FLIGHT_REQUESTS") or "64")
+# Timeout (in seconds) of requests to Pixiv and other upstream services, slower response counts as failure
+upstream_timeout = float(os.getenv("UPSTREAM_TIMEOUT") or "10")
+# Refresh tokens of the pool of Pixiv accounts, in JSON list
+pixiv_refresh_tokens: list[str] = json.loads(os.getenv("PIXIV_AUTH_TOKENS") or "[]") or [os.getenv("PIXIV_AUTH_TOKEN")]
+# Pixiv request rate (requests per second) and burst size of each account, shared by all queries
+pixiv_rate_limit = float(os.getenv("PIXIV_RATE_LIMIT") or "2")
+pixiv_rate_burst = max(int(os.getenv("PIXIV_RATE_BURST") or "10"), 2)
+# Random illustration candidates looked up at once, others are only started on failure or as hedge of slow lookup
+pixiv_random_fanout = max(int(os.getenv("PIXIV_RANDOM_FANOUT") or "1"), 1)
+# Interval (in seconds) of saving snapshot for warm restart, 0 to save only on shutdown
+snapshot_interval = float(os.getenv("SNAPSHOT_INTERVAL") or "300")
+# Number of worker processes, updates are polled by a front process and routed to workers by user if more than 1
+bot_workers = int(os.getenv("BOT_WORKERS") or "1")
+# Interval (in seconds) of checking data files for changes to reload, 0 to disable
+data_reload_interval = float(os.getenv("DATA_RELOAD_INTERVAL") or "30")
 base_data_dir = "data"
 start_time = datetime.now()
 file_path = {
   "list-bookmark-id": f"{base_data_dir}/bookmarks.txt",
   "list-acg-quote": f"{base_data_dir}/moegirl-acg-quotes.csv",
+  "meta-acg-quote": f"{base_data_dir}/moegirl-acg-quotes.meta.json",
   "list-admin": f"{base_data_dir}/admins.txt",
+  "list-pixiv-file-id": f"{base_data_dir}/pixiv-file-ids.csv",
+  "snapshot": f"{base_data_dir}/{bot_id}-snapshot.json.gz",
   "log-file": f"{base_data_dir}/{bot_id}-{start_time.strftime('%Y%m%d%H%M%S')}.log"
 }
 
 
-# OpenWeatherMap API (via pyowm)
-owm_config = OWMConfig.get_default_config()
-owm_config["language"] = "zh_tw"
-owm = OWM(os.getenv("OWM_API_TOKEN"), config=owm_config)
-owmwmgr = owm.weather_manager()
+# OpenWeatherMap API (via pyowm), created on first use
+owm: OWM | None = None
+owmwmgr: WeatherManager | None = None
+
+
+# Get the OpenWeatherMap API client, creating it on first use
+def get_owm() -> OWM:
+  global owm, owmwmgr
+  if owm is None:
+    from pyowm import OWM
+    from pyowm.utils import config as OWMConfig
+    owm_config = OWMConfig.get_default_config()
+    owm_config["language"] = "zh_tw"
+    owm = OWM(os.getenv("OWM_API_TOKEN"), config=owm_config)
+    owmwmgr = owm.weather_manager()
+  return owm
+
+
+def get_owm_manager() -> WeatherManager:
+  get_owm()
+  return owmwmgr
 
-# Pixiv (via pixivpy)
-api = AppPixivAPI()
-api.auth(refresh_token=os.getenv("PIXIV_AUTH_TOKEN"))
 
 # logger
 log = logging.getLogger(__name__)
@@ -99,11 +185,475 @@ quotes: list[list[str]] = [[] for x in range(4)]
 total_quotes_count = 0
 bookmark_ids = []
 admins = []
+# Modification time of each reloadable data file when it was last loaded
+data_mtimes: dict[str, float | None] = dict()
+# Serialize reloading of data files with writing to them
+data_reload_lock = asyncio.Lock()
+# Serialize bookmark syncs, so that concurrent syncs do not append the same ids
+bookmark_sync_lock = asyncio.Lock()
+
+# In-flight inline query task of each user
+inline_query_tasks: dict[int, asyncio.Task] = dict()
+# Deadline (in event loop time) of upstream work of current inline query, None if unbounded
+query_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("query_deadline", default=None)
 
 # Counter
 query_count: dict[str, int] = {"pixiv": 0, "weather": 0, "lucky": 0}
 
+# Index of this worker process, 0 if running in single process
+worker_index = 0
+# Counters of each worker shared by all workers, keyed by worker index, None if running in single process
+worker_stats = None
+# Interval (in seconds) of publishing counters of this worker to `worker_stats`
+stats_publish_interval = 5
+# Version of each reloadable data shared by all workers, changed by the worker changing the data,
+# None if running in single process
+data_versions = None
+# Versions in `data_versions` loaded by this worker
+loaded_data_versions: dict[str, str] = dict()
+# Interval (in seconds) of checking `data_versions` for data changed by other workers
+data_sync_interval = 2
+
+
+# Circuit breaker state of upstream service
+class Circuit(IntEnum):
+  CLOSED = 0,
+  OPEN = 1,
+  HALF_OPEN = 2,
+
+
+circuit_names = ["正常", "熔斷中", "試探中"]
+
+
+# Raised when the circuit breaker of upstream service is open
+class UpstreamUnavailable(Exception):
+  pass
+
+
+# Track the outcomes of recent calls to upstream service in a sliding `window` (in seconds)
+# Open the circuit when the failure rate reaches `failure_rate` with at least `min_calls` calls
+# After `open_duration` seconds, let `probe_calls` calls through to test if upstream is back
+class CircuitBreaker:
+  def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 6, window: float = 60,
+               open_duration: float = 30, probe_calls: int = 1):
+    self.name = name
+    self.failure_rate = failure_rate
+    self.min_calls = min_calls
+    self.window = window
+    self.open_duration = open_duration
+    self.probe_calls = probe_calls
+    self.state = Circuit.CLOSED
+    self.opened_at = 0.0
+    self.probing = 0
+    self.rejected_count = 0
+    self.outcomes: deque[tuple[float, bool]] = deque()
+
+  def allow(self) -> bool:
+    if self.state == Circuit.OPEN and time.monotonic() - self.opened_at >= self.open_duration:
+      self.state = Circuit.HALF_OPEN
+      self.probing = 0
+
+    if self.state == Circuit.CLOSED:
+      return True
+    if self.state == Circuit.HALF_OPEN and self.probing < self.probe_calls:
+      self.probing += 1
+      return True
+
+    self.rejected_count += 1
+    return False
+
+  def record(self, success: bool):
+    now = time.monotonic()
+    if self.state == Circuit.HALF_OPEN:
+      if success:
+        log.info("Circuit closed, upstream recovered #service=%s", self.name)
+        self.state = Circuit.CLOSED
+        self.outcomes.clear()
+      else:
+        self.trip(now)
+      return
+
+    self.outcomes.append((now, success))
+    while self.outcomes and now - self.outcomes[0][0] > self.window:
+      self.outcomes.popleft()
+    failures = sum(1 for _, ok in self.outcomes if not ok)
+    if self.state == Circuit.CLOSED and len(self.outcomes) >= self.min_calls and \
+        failures / len(self.outcomes) >= self.failure_rate:
+      self.trip(now)
+
+  # Give back the probe slot of call that was cancelled before its outcome is known
+  def release(self):
+    if self.state == Circuit.HALF_OPEN and self.probing > 0:
+      self.probing -= 1
+
+  def trip(self, now: float):
+    log.warning("Circuit opened for %ss #service=%s", self.open_duration, self.name)
+    self.state = Circuit.OPEN
+    self.opened_at = now
+    self.outcomes.clear()
+
+  def status(self) -> str:
+    # Report the state that the next call would see
+    if self.state == Circuit.OPEN and time.monotonic() - self.opened_at >= self.open_duration:
+      return circuit_names[Circuit.HALF_OPEN]
+    return circuit_names[self.state]
+
+
+circuit_breakers: dict[str, CircuitBreaker] = {
+  "pixiv": CircuitBreaker("pixiv"),
+  "owm": CircuitBreaker("owm"),
+  "twitter": CircuitBreaker("twitter")
+}
+
+
+# Cache with expiry time, the least recently used item is evicted when `maxsize` is reached
+class TTLCache:
+  def __init__(self, ttl: float, maxsize: int):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.items: OrderedDict = OrderedDict()
+
+  def get(self, key, default=None):
+    item = self.items.get(key)
+    if item is None:
+      return default
+    if item[0] <= time.monotonic():
+      del self.items[key]
+      return default
+    self.items.move_to_end(key)
+    return item[1]
+
+  def set(self, key, value, ttl: float | None = None):
+    self.items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+    self.items.move_to_end(key)
+    while len(self.items) > self.maxsize:
+      self.items.popitem(last=False)
+
+  def values(self) -> list:
+    now = time.monotonic()
+    return [value for expiry, value in self.items.values() if expiry > now]
+
+  # Unexpired (key, expiry, value), most recently used last, expiry in wall clock time to survive restart
+  def dump(self, limit: int | None = None) -> list[tuple]:
+    now = time.monotonic()
+    wall_now = time.time()
+    entries = [(key, wall_now + expiry - now, value) for key, (expiry, value) in self.items.items() if expiry > now]
+    return entries[-limit:] if limit else entries
+
+  # Restore entries from dump() with their remaining TTL, entries set since start are kept
+  def load(self, entries):
+    wall_now = time.time()
+    for key, wall_expiry, value in entries:
+      if wall_expiry > wall_now and key not in self.items:
+        self.set(key, value, ttl=wall_expiry - wall_now)
+
+  def __len__(self) -> int:
+    return len(self.items)
+
+
+# Priority of outbound Pixiv requests, lower value is served first
+class Priority(IntEnum):
+  INTERACTIVE = 0,
+  BACKGROUND = 1,
+
+
+priority_names = ["互動", "背景"]
+# Priority of Pixiv requests made by current task
+request_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("request_priority",
+                                                                           default=Priority.INTERACTIVE)
+
+
+# Token bucket refilled at `rate` tokens per second, holding up to `capacity` tokens
+class TokenBucket:
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  # Take a token if there are more than `reserve` tokens left
+  def consume(self, reserve: float = 0) -> bool:
+    self.refill()
+    if self.tokens >= 1 + reserve:
+      self.tokens -= 1
+      return True
+    return False
+
+  # Seconds until a token can be taken
+  def wait_time(self, reserve: float = 0) -> float:
+    self.refill()
+    return max(0.0, (1 + reserve - self.tokens) / self.rate)
+
+
+# Schedule outbound Pixiv requests under a global token bucket
+# Requests wait in the lane of their priority when no token is available, and lanes are served in
+# priority order. Background requests also leave `background_reserve` tokens for interactive bursts.
+class PixivScheduler:
+  def __init__(self, rate: float, burst: int, background_reserve: int = 1):
+    self.bucket = TokenBucket(rate, burst)
+    self.reserve = [0, background_reserve]
+    self.lanes: list[deque[asyncio.Future]] = [deque() for _ in Priority]
+    self.throttled_count = 0
+    self.dispatcher: asyncio.Task | None = None
+
+  async def acquire(self, priority: Priority):
+    if not any(self.lanes[:priority + 1]) and self.bucket.consume(self.reserve[priority]):
+      return
+
+    self.throttled_count += 1
+    waiter = asyncio.get_running_loop().create_future()
+    self.lanes[priority].append(waiter)
+    if self.dispatcher is None or self.dispatcher.done():
+      self.dispatcher = asyncio.create_task(self.dispatch())
+
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter in self.lanes[priority]:
+        self.lanes[priority].remove(waiter)
+      elif waiter.done() and not waiter.cancelled():
+        # Give back the token granted to the cancelled request
+        self.bucket.tokens += 1
+      raise
+
+  async def dispatch(self):
+    while any(self.lanes):
+      priority = next(p for p in Priority if self.lanes[p])
+      waiter = self.lanes[priority][0]
+      if waiter.done():
+        # Cancelled while waiting
+        self.lanes[priority].popleft()
+        continue
+
+      wait = self.bucket.wait_time(self.reserve[priority])
+      if wait > 0:
+        await asyncio.sleep(wait)
+        continue
+
+      self.bucket.consume(self.reserve[priority])
+      self.lanes[priority].popleft()
+      waiter.set_result(None)
+
+  def lane_depths(self) -> list[int]:
+    return [len(lane) for lane in self.lanes]
+
+
+pixiv_scheduler = PixivScheduler(pixiv_rate_limit * len(pixiv_refresh_tokens),
+                                 pixiv_rate_burst * len(pixiv_refresh_tokens))
+
+# Minimum interval (in seconds) between token refreshes of the same account
+pixiv_refresh_interval = 60
+# Refresh access token (valid for 3600 seconds) before it expires
+pixiv_token_lifetime = 3000
+# Duration (in seconds) of ejecting throttled or failing account from the pool
+pixiv_eject_duration = 300
+# Consecutive failures before ejecting an account
+pixiv_eject_failures = 3
+
+
+# Pixiv account with its own client and token lifecycle
+class PixivAccount:
+  def __init__(self, name: str, refresh_token: str):
+    self.name = name
+    self.refresh_token = refresh_token
+    self._api: AppPixivAPI | None = None
+    # Time of last successful authentication, 0 if never authenticated
+    self.auth_time = 0.0
+    self.auth_lock = asyncio.Lock()
+    self.in_flight = 0
+    self.request_count = 0
+    self.failure_count = 0
+    self.ejected_until = 0.0
+
+  # Client of this account, created on first use
+  @property
+  def api(self) -> AppPixivAPI:
+    if self._api is None:
+      from pixivpy3 import AppPixivAPI
+      self._api = AppPixivAPI(timeout=upstream_timeout)
+    return self._api
+
+  def healthy(self) -> bool:
+    return time.monotonic() >= self.ejected_until
+
+  def eject(self, reason: str):
+    log.warning("Pixiv account ejected for %ss #account=%s, #reason=%s", pixiv_eject_duration, self.name, reason)
+    self.ejected_until = time.monotonic() + pixiv_eject_duration
+    self.failure_count = 0
+
+  # Authenticate if the access token is missing or about to expire
+  # With `force`, refresh the token unless it was refreshed recently by other failed request
+  async def ensure_auth(self, force: bool = False):
+    async with self.auth_lock:
+      age = time.monotonic() - self.auth_time
+      if self.auth_time and age < (pixiv_refresh_interval if force else pixiv_token_lifetime):
+        return
+
+      log.info("Refreshing Pixiv token #account=%s", self.name)
+      try:
+        await call_upstream("pixiv", self.api.auth, refresh_token=self.refresh_token)
+      except (asyncio.TimeoutError, UpstreamUnavailable):
+        raise
+      except Exception:
+        self.eject("auth failed")
+        raise
+      self.auth_time = time.monotonic()
+
+
+# Spread Pixiv requests over the accounts in the pool
+class PixivAccountPool:
+  def __init__(self, refresh_tokens: list[str]):
+    self.accounts = [PixivAccount(f"{idx}", token) for idx, token in enumerate(refresh_tokens)]
+
+  # Pick the least loaded healthy account, or the one returning soonest if all are ejected
+  def acquire(self) -> PixivAccount:
+    healthy_accounts = [account for account in self.accounts if account.healthy()]
+    if not healthy_accounts:
+      return min(self.accounts, key=lambda account: account.ejected_until)
+    return min(healthy_accounts, key=lambda account: (account.in_flight, account.request_count))
+
+  def status(self) -> str:
+    return f"{sum(1 for account in self.accounts if account.healthy())}/{len(self.accounts)}"
+
+
+pixiv_pool = PixivAccountPool(pixiv_refresh_tokens)
+
+# Recently queried Pixiv illustrations, also served when Pixiv is unavailable
+illust_cache = TTLCache(ttl=3600, maxsize=1024)
+# Latency (in seconds) of recent illust_detail requests
+illust_latency_samples: deque[float] = deque(maxlen=200)
+# Candidates of random illustration looked up at most, and the hedge delay until enough latency is sampled
+max_random_candidates = 3
+default_hedge_delay = 1.0
+# Random illustrations served by the first candidate, by a later candidate, and hedged lookups started
+hedge_stats: dict[str, int] = {"first": 0, "later": 0, "hedged": 0}
+# Pages of related illustrations in (illusts, next_url), keyed by (pixiv_id, page)
+related_cache = TTLCache(ttl=3600, maxsize=256)
+# Pages of related illustrations served for each illustration, each page costs one Pixiv request to reach
+max_related_pages = 10
+# Built inline results in (results, answer arguments) of queries giving same results for all users
+inline_memo = TTLCache(ttl=300, maxsize=512)
+inline_memo_stats: dict[str, int] = {"lookups": 0, "hits": 0}
+# Cache time (in seconds) of empty results, which may be caused by temporary upstream error
+inline_negative_cache_time = 10
+
+
+# Queue outbound Bot API calls under the flood limits of Telegram
+# Calls to the same chat are sent in order by a worker of the chat. Pending call with the same
+# `coalesce_key` is replaced by the newer one, and RetryAfter is retried after the advertised delay.
+class TelegramSendQueue:
+  def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: int = 3, max_retries: int = 3):
+    self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+    self.chat_rate = chat_rate
+    self.chat_burst = chat_burst
+    self.max_retries = max_retries
+    self.chat_buckets = TTLCache(ttl=600, maxsize=65536)
+    # Pending jobs in [coalesce_key, factory, future] of each chat
+    self.queues: dict[int | str, deque[list]] = dict()
+    self.pending: dict = dict()
+    self.workers: set[asyncio.Task] = set()
+    self.coalesced_count = 0
+    self.retry_count = 0
+
+  # Queue the call `factory` to chat `chat_key`, return the future of its result
+  # The caller may leave the future unawaited, failures are logged by the worker
+  def submit(self, chat_key: int | str, factory, coalesce_key=None) -> asyncio.Future:
+    if coalesce_key is not None and coalesce_key in self.pending:
+      job = self.pending[coalesce_key]
+      job[1] = factory
+      self.coalesced_count += 1
+      return job[2]
+
+    future = asyncio.get_running_loop().create_future()
+    # Mark the exception retrieved, so that unawaited future does not warn
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    job = [coalesce_key, factory, future]
+    if coalesce_key is not None:
+      self.pending[coalesce_key] = job
+
+    queue = self.queues.get(chat_key)
+    if queue is None:
+      queue = self.queues[chat_key] = deque()
+      worker = asyncio.create_task(self.work(chat_key, queue))
+      self.workers.add(worker)
+      worker.add_done_callback(self.workers.discard)
+    queue.append(job)
+    return future
+
+  async def work(self, chat_key: int | str, queue: deque[list]):
+    try:
+      while queue:
+        job = queue.popleft()
+        await self.wait_token(chat_key)
+        # Calls submitted from now on are sent after this one
+        if job[0] is not None:
+          self.pending.pop(job[0], None)
+        await self.send(chat_key, job[1], job[2])
+    finally:
+      del self.queues[chat_key]
+
+  async def wait_token(self, chat_key: int | str):
+    bucket = self.chat_buckets.get(chat_key)
+    if bucket is None:
+      bucket = TokenBucket(self.chat_rate, self.chat_burst)
+    self.chat_buckets.set(chat_key, bucket)
+    while not bucket.consume():
+      await asyncio.sleep(bucket.wait_time())
+    while not self.global_bucket.consume():
+      await asyncio.sleep(self.global_bucket.wait_time())
+
+  async def send(self, chat_key: int | str, factory, future: asyncio.Future):
+    for attempt in range(self.max_retries + 1):
+      try:
+        future.set_result(await factory())
+        return
+      except RetryAfter as e:
+        self.retry_count += 1
+        log.warning("Flood limit reached, retry after %ss #chat=%s, #attempt=%s", e.retry_after, chat_key, attempt + 1)
+        if attempt == self.max_retries:
+          future.set_exception(e)
+          return
+        await asyncio.sleep(e.retry_after)
+      except Exception as e:
+        log.warning("Failed to send #chat=%s, #error=\"%r\"", chat_key, e)
+        future.set_exception(e)
+        return
+
+  def queue_depth(self) -> int:
+    return sum(len(queue) for queue in self.queues.values())
+
+
+send_queue = TelegramSendQueue()
+
+# Request token bucket of each user, dropped after idle for a while
+user_buckets = TTLCache(ttl=600, maxsize=65536)
+in_flight_requests = 0
+# Requests rejected by per-user rate limit, and requests shed due to overload
+admission_stats: dict[str, int] = {"throttled": 0, "shed": 0}
+
+# Telegram file_id of delivered Pixiv illustration pages, keyed by (pixiv_id, page)
+pixiv_file_ids: dict[tuple[int, int], str] = dict()
+# Bytes of the file_id list loaded into `pixiv_file_ids`, rows appended by other workers come after it
+pixiv_file_id_offset = 0
+# (pixiv_id, page, photo_url) of answered photo results not yet in `pixiv_file_ids`, keyed by result id
+pending_photo_results = TTLCache(ttl=600, maxsize=4096)
+# Pages being uploaded to `pixiv_cache_chat_id`
+uploading_photos: set[tuple[int, int]] = set()
+# Maximum number of illustrations being prefetched at the same time
+max_prefetch_tasks = 8
+prefetch_tasks = 0
+# Page flips, page flips served by prefetched file_id, and pages prefetched
+prefetch_stats: dict[str, int] = {"flips": 0, "hits": 0, "prefetched": 0}
+# Pages (pixiv_id, page) whose file_id was obtained by prefetching
+prefetched_pages: set[tuple[int, int]] = set()
+
 # Gacha game
+# Shared by all workers in multi-worker mode, so session must be written back after mutation
 gacha_store: dict[str, dict[str, int]] = dict()
 gacha_names = ["三星", "四星", "五星", "四星UP", "五星UP"]
 
@@ -132,9 +682,65 @@ gacha_init_profile: dict[str, int] = {
   "5starup_guarantee": 0
 }
 
+# Running totals of all gacha sessions, keyed by "sessions", "pulls", "648" and the count key of each rarity
+gacha_stats: dict[str, int] = {"sessions": 0, "pulls": 0, "648": 0, "3star": 0, "4star": 0, "5star": 0,
+                               "4starup": 0, "5starup": 0}
+# Count key of each gacha result, indexed as `gacha_names`
+gacha_result_keys = ["3star", "4star", "5star", "4starup", "5starup"]
+# Players shown in each leaderboard, and pulls required to enter the luck leaderboards
+gacha_leaderboard_size = 5
+gacha_leaderboard_min_pulls = 50
+
+
+# Top `k` keys by score, every key offered is indexed so that a key whose score drops can be overtaken
+# Offering a key is O(log n), reading the top is O(k log n) regardless of the number of keys
+class Leaderboard:
+  def __init__(self, k: int):
+    self.k = k
+    # Heap of [-score, sequence, key, label, valid] from the highest score, superseded entries are marked invalid
+    self.heap: list[list] = []
+    self.entries: dict[str, list] = dict()
+    self.sequence = 0
+
+  def offer(self, key: str, score: float, label: str):
+    entry = self.entries.get(key)
+    if entry is not None:
+      entry[-1] = False
+
+    # Earlier entry wins a tie
+    self.sequence += 1
+    entry = [-score, self.sequence, key, label, True]
+    self.entries[key] = entry
+    heapq.heappush(self.heap, entry)
+    if len(self.heap) > 2 * len(self.entries) + self.k:
+      self.heap = list(self.entries.values())
+      heapq.heapify(self.heap)
+
+  # (score, key, label) from the highest score
+  def top(self) -> list[tuple[float, str, str]]:
+    top_entries = []
+    while self.heap and len(top_entries) < self.k:
+      entry = heapq.heappop(self.heap)
+      if entry[-1]:
+        top_entries.append(entry)
+    for entry in top_entries:
+      heapq.heappush(self.heap, entry)
+    return [(-score, key, label) for score, _, key, label, _ in top_entries]
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.entries
+
+
+# Luckiest and unluckiest players by 5-star rate (negated for unluckiest), and players by 648 count
+gacha_leaderboards: dict[str, Leaderboard] = {
+  "luckiest": Leaderboard(gacha_leaderboard_size),
+  "unluckiest": Leaderboard(gacha_leaderboard_size),
+  "whales": Leaderboard(gacha_leaderboard_size)
+}
+
 help_text = f"""\
 *＊ 使用說明 ＊*
-目前支持__8__種命令：
+目前支持__9__種命令：
 
 *＊ 試試手氣* (0~1個參數)
 `@{bot_id}` [查詢事項]
@@ -142,6 +748,9 @@ help_text = f"""\
 *＊ 模擬抽卡* (1個參數)
 `@{bot_id}`
 
+*＊ 抽卡統計* (0個參數)
+`@{bot_id} g`
+
 *＊ 來點色圖* (0個參數)
 `@{bot_id}`
 
@@ -174,6 +783,136 @@ help_inline_reply = InlineQueryResultArticle(
   input_message_content=InputTextMessageContent(help_text, parse_mode=ParseMode.MARKDOWN_V2)
 )
 
+timeout_inline_reply = InlineQueryResultArticle(
+  id=uuid.uuid4().hex,
+  title="查詢逾時",
+  input_message_content=InputTextMessageContent("沒有結果"),
+  description="請稍後再試"
+)
+
+throttled_inline_reply = InlineQueryResultArticle(
+  id=uuid.uuid4().hex,
+  title="太快了，休息一下吧～",
+  input_message_content=InputTextMessageContent("太快了，休息一下吧～"),
+  description="請稍後再試"
+)
+
+unavailable_inline_reply = InlineQueryResultArticle(
+  id=uuid.uuid4().hex,
+  title="服務暫時不可用",
+  input_message_content=InputTextMessageContent("服務暫時不可用"),
+  description="請稍後再試"
+)
+
+
+# Remaining time (in seconds) before the deadline of current query, None if unbounded
+def time_remaining() -> float | None:
+  deadline = query_deadline.get()
+  if deadline is None:
+    return None
+  return deadline - asyncio.get_running_loop().time()
+
+
+def deadline_exceeded() -> bool:
+  remaining = time_remaining()
+  return remaining is not None and remaining <= 0
+
+
+# Admit request of user if the bot is not overloaded and the user is within rate limit
+def admit_request(user_id: int) -> bool:
+  if in_flight_requests >= max_in_flight_requests:
+    admission_stats["shed"] += 1
+    return False
+
+  bucket = user_buckets.get(user_id)
+  if bucket is None:
+    bucket = TokenBucket(user_rate_limit, user_rate_burst)
+  user_buckets.set(user_id, bucket)
+  if not bucket.consume():
+    admission_stats["throttled"] += 1
+    return False
+
+  return True
+
+
+# Run blocking call to upstream `service` in worker thread, bounded by the deadline of current query
+# Pixiv calls are scheduled by `pixiv_scheduler` with the priority of current task
+# Raise asyncio.TimeoutError if the deadline is reached, or UpstreamUnavailable if the circuit is open
+async def call_upstream(service: str, func, *args, **kwargs):
+  breaker = circuit_breakers[service]
+  if not breaker.allow():
+    raise UpstreamUnavailable(service)
+
+  try:
+    if service == "pixiv":
+      await asyncio.wait_for(pixiv_scheduler.acquire(request_priority.get()), timeout=time_remaining())
+    if deadline_exceeded():
+      raise asyncio.TimeoutError()
+  except (asyncio.CancelledError, asyncio.TimeoutError):
+    # Upstream was not called
+    breaker.release()
+    raise
+
+  # The call runs to completion even if the query gives up on it, so that the breaker only counts how upstream
+  # actually responded, upstream timeout is enforced by the client (`upstream_timeout`)
+  call = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+  call.add_done_callback(lambda f: breaker.release() if f.cancelled() else breaker.record(f.exception() is None))
+  return await asyncio.wait_for(asyncio.shield(call), timeout=time_remaining())
+
+
+# Fetch `url`, raise if the server is failing so that the circuit breaker can count it
+def fetch_url(url: str) -> requests.Response:
+  response = requests.get(url, timeout=upstream_timeout)
+  if response.status_code >= 500 or response.status_code == 429:
+    response.raise_for_status()
+  return response
+
+
+# Error message of Pixiv API `result`, empty if succeeded
+def pixiv_error_message(result: JsonDict) -> str:
+  if not result.error:
+    return ""
+  return str(result.error.message or result.error.user_message or result.error)
+
+
+# Query of `next_url` in Pixiv API result as keyword arguments, None if it is the last page
+def parse_pixiv_qs(next_url: str | None) -> dict | None:
+  from pixivpy3 import AppPixivAPI
+  return AppPixivAPI.parse_qs(next_url)
+
+
+# Call Pixiv API `method` with an account from the pool
+async def call_pixiv(method: str, *args, **kwargs) -> JsonDict:
+  account = pixiv_pool.acquire()
+  account.in_flight += 1
+  account.request_count += 1
+  try:
+    await account.ensure_auth()
+    result = await call_upstream("pixiv", getattr(account.api, method), *args, **kwargs)
+    if "OAuth" in pixiv_error_message(result):
+      # Refresh token once if expired
+      log.info("Pixiv token may expired, attempt to refresh... #account=%s", account.name)
+      await account.ensure_auth(force=True)
+      result = await call_upstream("pixiv", getattr(account.api, method), *args, **kwargs)
+  except (asyncio.TimeoutError, UpstreamUnavailable):
+    raise
+  except Exception:
+    account.failure_count += 1
+    if account.failure_count >= pixiv_eject_failures:
+      account.eject("failing")
+    raise
+  finally:
+    account.in_flight -= 1
+
+  error = pixiv_error_message(result)
+  if "Rate Limit" in error:
+    account.eject("throttled")
+  elif "OAuth" in error:
+    account.eject("auth failed")
+  else:
+    account.failure_count = 0
+  return result
+
 
 # Bot command matching
 def match_cmd(message: Message, cmd: str | None, required_bot_name: bool = True) -> bool:
@@ -192,44 +931,209 @@ def match_cmd(message: Message, cmd: str | None, required_bot_name: bool = True)
 async def handle_cmd(update: Update, context: CallbackContext):
   user = update.message.from_user
   log.info(
-    f"Received command #user_id={user.id}, #text=\"{update.message.text}\"")
+    "Received command #user_id=%s, #text=\"%s\"", user.id, update.message.text)
   if match_cmd(update.message, "start", True):
     await update.message.reply_text(text=f"哈囉～我是 {bot_id} ～！", quote=True)
   elif match_cmd(update.message, "say", True):
     await update.message.reply_text(text=quotes[0][random.randint(0, len(quotes[0]) - 1)], quote=True)
   elif match_cmd(update.message, "stats", True):
     await handle_bot_stats(update, context)
+  elif match_cmd(update.message, "gacha_stats", True):
+    await handle_gacha_stats(update, context)
   elif match_cmd(update.message, None, True):
     await update.message.reply_text(text="Sorry～我不懂你在說啥呢～！", quote=True)
 
 
+# Usage: /bot_log [time range, e.g. 30m, 2h, 1d] [minimum level, e.g. WARNING]
 async def handle_bot_log(update: Update, context: CallbackContext):
   if update.message and update.message.chat.type == "private":
     if update.message.from_user.id in admins:
-      await update.message.reply_document(document=open(file_path["log-file"], "r"), quote=True)
+      since: datetime | None = None
+      min_level = logging.NOTSET
+      for arg in context.args or []:
+        matches = re.fullmatch(r"(\d+)([smhd])", arg.lower())
+        if matches is not None:
+          unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[matches.group(2)]
+          since = datetime.now().astimezone() - timedelta(**{unit: int(matches.group(1))})
+        elif isinstance(logging.getLevelName(arg.upper()), int):
+          min_level = logging.getLevelName(arg.upper())
+        else:
+          await update.message.reply_text("用法：/bot_log [時間範圍，例如 30m、2h、1d] [最低等級，例如 WARNING]", quote=True)
+          return
+
+      # Compress the matching lines into temporary file outside the event loop
+      with tempfile.TemporaryFile() as archive:
+        n = await asyncio.to_thread(export_logs, archive, since, min_level)
+        archive.seek(0)
+        await update.message.reply_document(document=archive, filename=f"{bot_id}-log.gz",
+                                            caption=f"共 {n} 行", quote=True)
     else:
       await update.message.reply_text("不能看喔～", quote=True)
 
 
+# Time and level of log line, None if it continues the previous line (e.g. traceback)
+def parse_log_header(line: str) -> tuple[datetime, int] | None:
+  if line.startswith("{"):
+    try:
+      entry = json.loads(line)
+      return datetime.strptime(entry["time"], log_datefmt), logging.getLevelName(entry["level"])
+    except (ValueError, KeyError):
+      return None
+
+  matches = re.match(r"(\S+) (DEBUG|INFO|WARNING|ERROR|CRITICAL) ", line)
+  if matches is None:
+    return None
+  try:
+    return datetime.strptime(matches.group(1), log_datefmt), logging.getLevelName(matches.group(2))
+  except ValueError:
+    return None
+
+
+# Write gzip of log lines since `since` with at least `min_level` from the rotated and current log files
+# to `archive` line by line, return the number of lines written
+def export_logs(archive, since: datetime | None, min_level: int) -> int:
+  paths = [f"{file_path['log-file']}.{idx}" for idx in range(log_backup_count, 0, -1)] + [file_path["log-file"]]
+  n = 0
+  with gzip.open(archive, "wt", encoding="utf-8") as out:
+    for path in paths:
+      if not os.path.exists(path):
+        continue
+      with open(path, "r", encoding="utf-8", errors="replace") as f:
+        matched = False
+        for line in f:
+          header = parse_log_header(line)
+          if header is not None:
+            matched = header[1] >= min_level and (since is None or header[0] >= since)
+          if matched:
+            out.write(line)
+            n += 1
+
+  return n
+
+
+# Counters of this worker, by name
+def counter_dicts() -> dict[str, dict[str, int]]:
+  return {
+    "query_count": query_count,
+    "admission_stats": admission_stats,
+    "inline_memo_stats": inline_memo_stats,
+    "prefetch_stats": prefetch_stats,
+    "hedge_stats": hedge_stats,
+    "gacha_stats": gacha_stats
+  }
+
+
+def local_counters() -> dict[str, dict[str, int]]:
+  return {name: dict(values) for name, values in counter_dicts().items()}
+
+
+# Counters and gacha leaderboards of this worker, published to other workers
+def worker_state() -> dict:
+  return {
+    "counters": local_counters(),
+    "leaderboards": {name: board.top() for name, board in gacha_leaderboards.items()}
+  }
+
+
+# Call `func` of shared store in worker thread, a SyncManager proxy call blocks for the round trip to the manager
+async def call_shared(func, *args):
+  if worker_stats is None:
+    return func(*args)
+  return await asyncio.to_thread(func, *args)
+
+
+def exchange_worker_state(state: dict) -> list[dict]:
+  worker_stats[worker_index] = state
+  return worker_stats.values()
+
+
+# States of all workers, including the current state of this worker
+async def worker_states() -> list[dict]:
+  state = worker_state()
+  if worker_stats is None:
+    return [state]
+  return await asyncio.to_thread(exchange_worker_state, state)
+
+
+# Counters summed over worker `states`
+def aggregate_counters(states: list[dict]) -> dict[str, dict[str, int]]:
+  total: dict[str, dict[str, int]] = dict()
+  for state in states:
+    for name, values in state["counters"].items():
+      for key, value in values.items():
+        total.setdefault(name, dict())
+        total[name][key] = total[name].get(key, 0) + value
+  return total
+
+
+# Publish counters of this worker periodically
+async def publish_counters():
+  while True:
+    await asyncio.sleep(stats_publish_interval)
+    await asyncio.to_thread(worker_stats.__setitem__, worker_index, worker_state())
+
+
 async def handle_bot_stats(update: Update, context: CallbackContext):
+  counters = aggregate_counters(await worker_states())
+  # Upstream and send queue state is kept by each worker, shown for the worker answering
+  local_label = f" \\(工作進程 {worker_index}\\)" if worker_stats is not None else ""
   reply_text = textwrap.dedent(f"""\
     *＊ {escape_markdown(bot_id, version=2)} 統計數據 ＊*
     *＊ 運行時間:* {datetime.now() - start_time}
+    *＊ 工作進程:* {bot_workers}
     *＊ 色圖數量:* {len(bookmark_ids)}
     *＊ ACG名言數量:* {total_quotes_count}
-    *＊ 色圖查詢次數:* {query_count.get("pixiv", 0)}
-    *＊ 天氣查詢次數:* {query_count.get("weather", 0)}
-    *＊ 占卜查詢次數:* {query_count.get("lucky", 0)}
+    *＊ 色圖查詢次數:* {counters["query_count"].get("pixiv", 0)}
+    *＊ 天氣查詢次數:* {counters["query_count"].get("weather", 0)}
+    *＊ 占卜查詢次數:* {counters["query_count"].get("lucky", 0)}
+    *＊ 上游服務狀態{local_label}:* {"、".join(f"{name} {breaker.status()}" for name, breaker in circuit_breakers.items())}
+    *＊ 熔斷拒絕次數{local_label}:* {sum(breaker.rejected_count for breaker in circuit_breakers.values())}
+    *＊ Pixiv 請求佇列{local_label}:* {"、".join(f"{priority_names[p]} {n}" for p, n in enumerate(pixiv_scheduler.lane_depths()))}
+    *＊ Pixiv 限流次數{local_label}:* {pixiv_scheduler.throttled_count}
+    *＊ Pixiv 可用帳號{local_label}:* {pixiv_pool.status()}
+    *＊ 限流次數:* 用戶 {counters["admission_stats"]["throttled"]}、過載 {counters["admission_stats"]["shed"]}
+    *＊ 發送佇列{local_label}:* 等待 {send_queue.queue_depth()}、合併 {send_queue.coalesced_count}、重試 {send_queue.retry_count}
+    *＊ 結果快取命中率:* {counters["inline_memo_stats"]["hits"]}/{counters["inline_memo_stats"]["lookups"]}
+    *＊ 隨機色圖對沖:* 首選 {counters["hedge_stats"]["first"]}、後備 {counters["hedge_stats"]["later"]}、對沖 {counters["hedge_stats"]["hedged"]}
+    *＊ 翻頁預取命中率:* {counters["prefetch_stats"]["hits"]}/{counters["prefetch_stats"]["flips"]}，已預取 {counters["prefetch_stats"]["prefetched"]} 頁
     ＊ 使用 /bot\\_log 下載運行日誌""")
   reply_text = re.sub(r"([.-])", r"\\\1", reply_text)
   await update.message.reply_text(reply_text, parse_mode=ParseMode.MARKDOWN_V2, quote=True)
 
 
+# Usage: /reload [quotes|bookmarks|admins], reload all if not specified
+async def handle_reload(update: Update, context: CallbackContext):
+  if update.message and update.message.chat.type == "private":
+    if update.message.from_user.id in admins:
+      names = context.args or list(reloadable_data)
+      if any(name not in reloadable_data for name in names):
+        await update.message.reply_text(f"可重新載入: {', '.join(reloadable_data)}", quote=True)
+        return
+
+      failed = []
+      for name in names:
+        try:
+          await reload_data(name)
+        except Exception:
+          log.exception("Failed to reload data #name=%s", name)
+          failed.append(name)
+          continue
+        # Other workers reload it as well
+        await publish_data_change(name)
+
+      reply_text = f"已重新載入 {', '.join(name for name in names if name not in failed) or '-'}"
+      if failed:
+        reply_text += f"，失敗: {', '.join(failed)}"
+      await update.message.reply_text(reply_text, quote=True)
+    else:
+      await update.message.reply_text("這個命令不能亂用喔～", quote=True)
+
+
 async def handle_update_bookmarks(update: Update, context: CallbackContext):
   if update.message and update.message.chat.type == "private":
     if update.message.from_user.id in admins:
       msg: Message = await context.bot.send_message(chat_id=update.effective_chat.id, text="正在更新 Pixiv 書籤索引")
-      n = fetch_latest_bookmarks()
+      n = await fetch_latest_bookmarks()
       await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=msg.message_id,
                                     text=f"新增了 {n} 個新項目")
     else:
@@ -263,33 +1167,41 @@ def make_quote_reply(query_text: str) -> List[InlineQueryResultArticle]:
   return results
 
 
+# Fetch Pixiv illustration detail of `pixiv_id`
+# The blocking API calls run in worker thread, so that the caller can be cancelled between them
+async def fetch_pixiv_illust(pixiv_id: int) -> JsonDict | None:
+  illust = illust_cache.get(pixiv_id)
+  if illust is not None:
+    return illust
+
+  started = time.monotonic()
+  result = await call_pixiv("illust_detail", pixiv_id)
+  illust_latency_samples.append(time.monotonic() - started)
+  if result.illust:
+    illust_cache.set(pixiv_id, result.illust)
+  return result.illust
+
+
 # Generate Pixiv illustration reply from `pixiv_id`
-def make_pixiv_illust_reply(pixiv_id: int | None = None,
-                            illust: JsonDict | None = None,
-                            page: int = 0) -> InlineQueryResultPhoto | None:
+async def make_pixiv_illust_reply(pixiv_id: int | None = None,
+                                  illust: JsonDict | None = None,
+                                  page: int = 0) -> InlineQueryResultPhoto | InlineQueryResultCachedPhoto | None:
   if (pixiv_id is None) == (illust is None):
     log.error("Detected incorrect usage, either pixiv_id or illust should provide value")
     return
 
   if pixiv_id is not None:
     if should_log_pixiv_query == 1:
-      log.info(f"Querying Pixiv illustration #pixiv_id={pixiv_id}")
-    result = api.illust_detail(pixiv_id)
-    illust = result.illust
-    if not illust:
-      # Refresh token once if failed
-      log.info("Pixiv token may expired, attempt to refresh...")
-      api.auth(refresh_token=os.getenv("PIXIV_AUTH_TOKEN"))
-      result = api.illust_detail(pixiv_id)
-      illust = result.illust
+      log.info("Querying Pixiv illustration #pixiv_id=%s", pixiv_id)
+    illust = await fetch_pixiv_illust(pixiv_id)
 
   if illust:
     if not illust.visible:
-      log.info(f"Queried ID exists but not currently accessible #pixiv_id={illust.id}")
+      log.info("Queried ID exists but not currently accessible #pixiv_id=%s", illust.id)
       return
 
     if pixiv_id is not None and should_log_pixiv_query == 1:
-      log.info(f"Query sucessful #pixiv_id={pixiv_id}, #title=\"{illust.title}\"")
+      log.info("Query sucessful #pixiv_id=%s, #title=\"%s\"", pixiv_id, illust.title)
     title = escape_markdown(illust.title, version=2)
     author = escape_markdown(illust.user.name, version=2)
     caption_text = textwrap.dedent(f"""\
@@ -310,28 +1222,39 @@ def make_pixiv_illust_reply(pixiv_id: int | None = None,
       ]
     ]
     
-    # Get image of higher quality
-    img_url = re.sub("c/600x1200_90/", "", illust.image_urls.large)
-    
     if illust.meta_pages:
       keyboard.insert(0, [
         InlineKeyboardButton(
-          text="上一頁 ⬅️", callback_data=json.dumps({"id": pixiv_id, "page": page-1, "type": "pixiv"})),
+          text="上一頁 ⬅️", callback_data=json.dumps({"id": illust.id, "page": page-1, "type": "pixiv"})),
         InlineKeyboardButton(text=f"• {page} •", callback_data="{}"),
         InlineKeyboardButton(
-          text="下一頁 ➡️", callback_data=json.dumps({"id": pixiv_id, "page": page+1, "type": "pixiv"}))
+          text="下一頁 ➡️", callback_data=json.dumps({"id": illust.id, "page": page+1, "type": "pixiv"}))
       ])
       
       if page < 0 or page >= len(illust.meta_pages):
         return
-      img_url = re.sub("c/600x1200_90/", "", illust.meta_pages[page].image_urls.large)
-        
-    
+
+    img_url = pixiv_page_url(illust, page)
     reply_markup = InlineKeyboardMarkup(keyboard)
     query_count["pixiv"] += 1
 
+    # Telegram does not need to fetch the image again if it was delivered before
+    file_id = pixiv_file_ids.get((illust.id, page))
+    if file_id is not None:
+      return InlineQueryResultCachedPhoto(
+        id=uuid.uuid4().hex,
+        title="來點色圖",
+        description=illust.title,
+        photo_file_id=file_id,
+        caption=caption_text,
+        parse_mode=ParseMode.MARKDOWN_V2,
+        reply_markup=reply_markup
+      )
+
+    result_id = uuid.uuid4().hex
+    pending_photo_results.set(result_id, (illust.id, page, img_url))
     return InlineQueryResultPhoto(
-      id=uuid.uuid4().hex,
+      id=result_id,
       title="來點色圖",
       description=illust.title,
       photo_url=img_url,
@@ -341,20 +1264,89 @@ def make_pixiv_illust_reply(pixiv_id: int | None = None,
       reply_markup=reply_markup
     )
 
-  log.error(f"Query failed #pixiv_id={pixiv_id}")
+  log.error("Query failed #pixiv_id=%s", pixiv_id)
+
+
+# Image URL of `page` of Pixiv illustration
+def pixiv_page_url(illust: JsonDict, page: int = 0) -> str:
+  image_urls = illust.meta_pages[page].image_urls if illust.meta_pages else illust.image_urls
+  # Get image of higher quality
+  return re.sub("c/600x1200_90/", "", image_urls.large)
+
+
+# Delay before hedging a random illustration lookup, the 90th percentile of recent illust_detail latency
+def hedge_delay() -> float:
+  if len(illust_latency_samples) < 20:
+    return default_hedge_delay
+  samples = sorted(illust_latency_samples)
+  return samples[int(len(samples) * 0.9)]
 
 
 # Fetch random Pixiv illustration
-def get_random_pixiv_illust() -> InlineQueryResultPhoto | InlineQueryResultArticle:
-  # Retry up to 3 times
-  for retry_count in range(1, 4):
-    pxid = bookmark_ids[random.randint(0, len(bookmark_ids) - 1)]
-    reply_image = make_pixiv_illust_reply(pixiv_id=pxid)
-    if reply_image:
-      return reply_image
-    log.warning(f"Retrying pixiv query for the {retry_count} of 3 times #pixiv_id={pxid}")
-
-  log.warning("Retry limit reached")
+async def get_random_pixiv_illust() -> InlineQueryResultPhoto | InlineQueryResultCachedPhoto | InlineQueryResultArticle:
+  # Bookmarks are still being synced on the first start
+  if not bookmark_ids:
+    return unavailable_inline_reply
+
+  # Look up the next candidate as soon as one fails, or hedge when the lookup is slower than usual
+  candidates = random.sample(bookmark_ids, min(max_random_candidates, len(bookmark_ids)))
+  # Candidate lookups in flight, task -> (pixiv_id, order of launch)
+  pending: dict[asyncio.Task, tuple[int, int]] = dict()
+  launched = 0
+  # Error of the last failed lookup, and number of lookups failed with error
+  last_error: Exception | None = None
+  error_count = 0
+  try:
+    while candidates or pending:
+      while candidates and len(pending) < pixiv_random_fanout:
+        pxid = candidates.pop()
+        pending[asyncio.create_task(make_pixiv_illust_reply(pixiv_id=pxid))] = (pxid, launched)
+        launched += 1
+
+      done, _ = await asyncio.wait(pending, timeout=hedge_delay() if candidates else None,
+                                   return_when=asyncio.FIRST_COMPLETED)
+      if not done:
+        pxid = candidates.pop()
+        log.info("Hedging slow pixiv query #pixiv_id=%s", pxid)
+        hedge_stats["hedged"] += 1
+        pending[asyncio.create_task(make_pixiv_illust_reply(pixiv_id=pxid))] = (pxid, launched)
+        launched += 1
+        continue
+
+      for task in done:
+        pxid, order = pending.pop(task)
+        try:
+          reply_image = task.result()
+        except UpstreamUnavailable:
+          # Serve recently queried illustration instead
+          cached_illusts = [illust for illust in illust_cache.values() if illust.visible]
+          if cached_illusts:
+            return await make_pixiv_illust_reply(illust=random.choice(cached_illusts))
+          return unavailable_inline_reply
+        except asyncio.TimeoutError:
+          # Out of time for all candidates
+          raise
+        except Exception as e:
+          log.warning("Pixiv query of random candidate failed #pixiv_id=%s, #error=\"%r\"", pxid, e)
+          last_error = e
+          error_count += 1
+          continue
+
+        if reply_image:
+          hedge_stats["first" if order == 0 else "later"] += 1
+          return reply_image
+        log.warning("Pixiv query of random candidate failed #pixiv_id=%s", pxid)
+  finally:
+    # Lookups of the other candidates are no longer needed, and the errors of finished ones are not
+    for task in pending:
+      task.cancel()
+      task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+  log.warning("All random candidates failed")
+  if last_error is not None and error_count == launched:
+    # Upstream is failing, though the circuit is not open yet
+    log.warning("Pixiv query failed for all random candidates #error=\"%r\"", last_error)
+    return unavailable_inline_reply
   # Feedback reply
   return InlineQueryResultArticle(
     id=uuid.uuid4().hex,
@@ -364,47 +1356,189 @@ def get_random_pixiv_illust() -> InlineQueryResultPhoto | InlineQueryResultArtic
 
 
 # Fetch related Pixiv illustration
-def get_related_pixiv_illust(pxid: int) -> List[InlineQueryResultPhoto]:
-  result = api.illust_related(pxid)
+# Return the replies of `page` and whether there are more pages
+async def get_related_pixiv_illust(pxid: int,
+                                   page: int = 0) -> tuple[List[InlineQueryResultPhoto | InlineQueryResultCachedPhoto], bool]:
+  illusts, next_url = await fetch_related_page(pxid, page)
   replies = []
-  if not result.illusts:
-    # Refresh token once if failed
-    log.info("Pixiv token may expired, attempt to refresh...")
-    api.auth(refresh_token=os.getenv("PIXIV_AUTH_TOKEN"))
-    result = api.illust_related(pxid)
-
-  if not result.illusts:
-    return replies
-
-  for illust in result.illusts:
-    i = make_pixiv_illust_reply(illust=illust)
+  for illust in illusts:
+    i = await make_pixiv_illust_reply(illust=illust)
     if i is not None:
       replies.append(i)
 
-  return replies
+  return replies, next_url is not None and page + 1 < max_related_pages
+
+
+# Fetch `page` of related illustrations, following the next_url of pages from the last cached one
+async def fetch_related_page(pxid: int, page: int) -> tuple[list[JsonDict], str | None]:
+  cached = related_cache.get((pxid, page))
+  if cached is not None:
+    return cached
+
+  # Start from the page after the last cached page, or the first page
+  start, next_url = page - 1, None
+  while start >= 0:
+    cached = related_cache.get((pxid, start))
+    if cached is not None:
+      next_url = cached[1]
+      break
+    start -= 1
+
+  for p in range(start + 1, page + 1):
+    if p == 0:
+      result = await call_pixiv("illust_related", pxid)
+    elif next_url is None:
+      return [], None
+    else:
+      result = await call_pixiv("illust_related", **parse_pixiv_qs(next_url))
+
+    if not result.illusts:
+      # Do not cache failed query
+      return [], None
+
+    for illust in result.illusts:
+      illust_cache.set(illust.id, illust)
+    related_cache.set((pxid, p), (result.illusts, result.next_url))
+    next_url = result.next_url
+
+  return result.illusts, result.next_url
+
 
 async def handle_pixiv_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
   query = update.callback_query
   callback_data: dict[str, int | str] = json.loads(query.data)
   
   if callback_data.get("action") == "change":
-    update_result = get_random_pixiv_illust()
+    update_result = await get_random_pixiv_illust()
     
   elif "id" in callback_data and "page" in callback_data:
-    update_result = make_pixiv_illust_reply(pixiv_id=callback_data["id"], page=callback_data["page"])
+    prefetch_stats["flips"] += 1
+    if (callback_data["id"], callback_data["page"]) in prefetched_pages:
+      prefetch_stats["hits"] += 1
+    try:
+      update_result = await make_pixiv_illust_reply(pixiv_id=callback_data["id"], page=callback_data["page"])
+    except UpstreamUnavailable:
+      await query.answer("服務暫時不可用", show_alert=True)
+      return
     if not update_result:
       await query.answer("已經到底啦！", show_alert=True)
       return
+
+  if isinstance(update_result, InlineQueryResultCachedPhoto):
+    media = update_result.photo_file_id
+  elif isinstance(update_result, InlineQueryResultPhoto):
+    media = update_result.photo_url
+  else:
+    await query.answer(update_result.title, show_alert=True)
+    return
   
-  # Update existing message
-  await query.edit_message_media(
+  # Update existing message, without waiting for the flood limit of the chat
+  chat_key, _ = callback_message_key(query)
+  edit = send_queue.submit(chat_key, lambda: query.edit_message_media(
     media=InputMediaPhoto(
-      media=update_result.photo_url, 
+      media=media, 
       caption=update_result.caption, 
       parse_mode=update_result.parse_mode
     ),
     reply_markup=update_result.reply_markup
-  )
+  ))
+
+  pending = pending_photo_results.get(update_result.id)
+  if pending is not None:
+    edit.add_done_callback(lambda future: record_edited_pixiv_photo(context, pending, future))
+
+  if "page" in callback_data:
+    schedule_prefetch(context, callback_data["id"], callback_data["page"])
+  elif pending is not None:
+    schedule_prefetch(context, pending[0], pending[1])
+
+
+# Record the file_id of page `pending` (pixiv_id, page, photo_url) after its message is edited
+def record_edited_pixiv_photo(context: CallbackContext, pending: tuple[int, int, str], future: asyncio.Future):
+  if future.cancelled() or future.exception() is not None:
+    return
+  message = future.result()
+  # Inline message is edited without returning the message, upload the photo to get its file_id instead
+  if isinstance(message, Message) and message.photo:
+    record_pixiv_file_id(pending[0], pending[1], message.photo[-1].file_id)
+  else:
+    context.application.create_task(upload_pixiv_photo(context, *pending))
+
+
+# Chat and message of callback query, the chat of inline message is unknown to bot
+def callback_message_key(query: CallbackQuery) -> tuple[int | str, int | None]:
+  if query.message is not None:
+    return query.message.chat_id, query.message.message_id
+  return query.inline_message_id, None
+
+
+# Save the file_id of delivered page of Pixiv illustration
+def record_pixiv_file_id(pixiv_id: int, page: int, file_id: str):
+  if (pixiv_id, page) in pixiv_file_ids:
+    return
+  pixiv_file_ids[(pixiv_id, page)] = file_id
+  with open(file_path["list-pixiv-file-id"], "a") as f:
+    csv.writer(f).writerow([pixiv_id, page, file_id])
+
+
+# Upload page of Pixiv illustration to `pixiv_cache_chat_id` to obtain its file_id,
+# return whether the file_id is recorded by this upload
+async def upload_pixiv_photo(context: CallbackContext, pixiv_id: int, page: int, photo_url: str) -> bool:
+  key = (pixiv_id, page)
+  if not pixiv_cache_chat_id or key in pixiv_file_ids or key in uploading_photos:
+    return False
+
+  uploading_photos.add(key)
+  try:
+    message = await send_queue.submit(pixiv_cache_chat_id, lambda: context.bot.send_photo(
+      chat_id=pixiv_cache_chat_id, photo=photo_url, disable_notification=True))
+    record_pixiv_file_id(pixiv_id, page, message.photo[-1].file_id)
+    return True
+  except TelegramError as e:
+    log.warning("Failed to upload Pixiv illustration #pixiv_id=%s, #page=%s, #error=\"%s\"", pixiv_id, page, e)
+    return False
+  finally:
+    uploading_photos.discard(key)
+
+
+# Warm the pages next to `page` of Pixiv illustration in background, so that page flips feel instant
+def schedule_prefetch(context: CallbackContext, pixiv_id: int, page: int):
+  global prefetch_tasks
+  if pixiv_prefetch_depth <= 0 or prefetch_tasks >= max_prefetch_tasks:
+    return
+
+  prefetch_tasks += 1
+  context.application.create_task(prefetch_pixiv_pages(context, pixiv_id, page))
+
+
+async def prefetch_pixiv_pages(context: CallbackContext, pixiv_id: int, page: int):
+  global prefetch_tasks
+  priority_token = request_priority.set(Priority.BACKGROUND)
+  try:
+    # Resolve page URLs, the illustration is usually in cache already
+    illust = await fetch_pixiv_illust(pixiv_id)
+    if not illust or not illust.meta_pages:
+      return
+
+    for distance in range(1, pixiv_prefetch_depth + 1):
+      for p in (page + distance, page - distance):
+        if 0 <= p < len(illust.meta_pages) and (pixiv_id, p) not in pixiv_file_ids and pixiv_cache_chat_id:
+          if await upload_pixiv_photo(context, pixiv_id, p, pixiv_page_url(illust, p)):
+            prefetched_pages.add((pixiv_id, p))
+            prefetch_stats["prefetched"] += 1
+  except (asyncio.TimeoutError, UpstreamUnavailable, TelegramError) as e:
+    log.info("Prefetch stopped #pixiv_id=%s, #page=%s, #error=\"%r\"", pixiv_id, page, e)
+  finally:
+    request_priority.reset(priority_token)
+    prefetch_tasks -= 1
+
+
+# Record the photo result chosen by user (requires inline feedback enabled in @BotFather)
+async def handle_chosen_inline_result(update: Update, context: CallbackContext):
+  pending = pending_photo_results.get(update.chosen_inline_result.result_id)
+  if pending is not None:
+    schedule_prefetch(context, pending[0], pending[1])
+    await upload_pixiv_photo(context, *pending)
 
 
 # Generate weather reply based on given `locations`
@@ -412,9 +1546,17 @@ async def make_owm_reply(locations: list) -> list[InlineQueryResultArticle]:
   results = []
   for target in locations:
     loc_name = f'{target[1]}, {target[2]}{", " if target[3] else ""}{target[3] or ""}'
-    observation = owmwmgr.weather_at_coords(target[4], target[5])
+    try:
+      observation = await call_upstream("owm", get_owm_manager().weather_at_coords, target[4], target[5])
+    except asyncio.TimeoutError:
+      # Answer with the results that are ready
+      log.warning("Deadline reached with %s of %s locations queried", len(results), len(locations))
+      return results or [timeout_inline_reply]
+    except UpstreamUnavailable:
+      return results or [unavailable_inline_reply]
+
     if observation is None:
-      log.warning(f"0 result from OpenWeatherMap API received #location=\"{loc_name}\", #lat={target[4]}, #lon={target[5]}")
+      log.warning("0 result from OpenWeatherMap API received #location=\"%s\", #lat=%s, #lon=%s", loc_name, target[4], target[5])
       return [InlineQueryResultArticle(
         id=uuid.uuid4().hex,
         title="沒有結果",
@@ -426,7 +1568,7 @@ async def make_owm_reply(locations: list) -> list[InlineQueryResultArticle]:
     temp_data = weather.temperature(unit="celsius")
     wind_data = weather.wind(unit="km_hour")
     pressure = weather.barometric_pressure()
-    log.info(f"Query sucessful #location=\"{loc_name}\"")
+    log.info("Query sucessful #location=\"%s\"", loc_name)
     reply_text = textwrap.dedent(f"""\
       *{loc_name} 天氣報告*
       
@@ -459,9 +1601,9 @@ async def make_owm_reply(locations: list) -> list[InlineQueryResultArticle]:
 
 
 # Generate downloadable illustration link reply
-def make_twi_reply(twid: int) -> InlineQueryResultArticle | None:
+async def make_twi_reply(twid: int) -> InlineQueryResultArticle | None:
   url = f"https://cdn.syndication.twimg.com/tweet?id={twid}"
-  response = requests.get(url)
+  response = await call_upstream("twitter", fetch_url, url)
   # requests may not detect the correct encoding
   response.encoding = 'UTF-8'
   reply = response.text
@@ -625,6 +1767,103 @@ def do_gacha(gacha_data: dict[str, int]) -> Gacha:
     return Gacha.THREE
   
 
+def record_gacha_result(result: Gacha):
+  gacha_stats["pulls"] += 1
+  gacha_stats[gacha_result_keys[result - 3]] += 1
+
+
+# Offer the current scores of session `gacha_id` to the leaderboards
+def update_gacha_leaderboards(gacha_id: str, gacha_data: dict[str, int]):
+  name = gacha_data.get("name") or str(gacha_data["owner"])
+  if gacha_data["total_pulls"] >= gacha_leaderboard_min_pulls:
+    rate = (gacha_data["5star_count"] + gacha_data["5starup_count"]) / gacha_data["total_pulls"]
+    gacha_leaderboards["luckiest"].offer(gacha_id, rate, name)
+    gacha_leaderboards["unluckiest"].offer(gacha_id, -rate, name)
+  if gacha_data["648_count"] > 0:
+    gacha_leaderboards["whales"].offer(gacha_id, gacha_data["648_count"], name)
+
+
+# Worker offering session `gacha_data` to its leaderboards. Callbacks of inline messages are routed by user,
+# and only the owner changes the session
+def gacha_session_worker(gacha_data: dict[str, int]) -> int:
+  return gacha_data["owner"] % bot_workers
+
+
+# Leaderboards merged over worker `states`
+def gacha_leaderboard_tops(states: list[dict]) -> dict[str, list[tuple[float, str, str]]]:
+  # Best entry of each session, in case the session moved to another worker
+  merged: dict[str, dict[str, tuple[float, str, str]]] = {name: dict() for name in gacha_leaderboards}
+  for state in states:
+    for name, entries in state["leaderboards"].items():
+      for score, key, label in entries:
+        if key not in merged[name] or score > merged[name][key][0]:
+          merged[name][key] = (score, key, label)
+  return {name: sorted(entries.values(), reverse=True)[:gacha_leaderboard_size] for name, entries in merged.items()}
+
+
+# Global gacha statistics in MarkdownV2, from the running totals and leaderboards
+async def make_gacha_stats_text() -> str:
+  states = await worker_states()
+  stats = aggregate_counters(states)["gacha_stats"]
+  tops = gacha_leaderboard_tops(states)
+  pulls = stats.get("pulls", 0)
+  four_count = stats.get("4star", 0) + stats.get("4starup", 0)
+  five_count = stats.get("5star", 0) + stats.get("5starup", 0)
+
+  def esc(value) -> str:
+    return escape_markdown(str(value), version=2)
+
+  def ratio(n: int, total: int) -> str:
+    return esc(f"{n / total:.2%}") if total else "\\-"
+
+  def board(entries: list[tuple[float, str, str]], format_score) -> list[str]:
+    if not entries:
+      return ["暫無"]
+    return [f"{rank}\\. {esc(label)}: {esc(format_score(score))}" for rank, (score, _, label) in enumerate(entries, 1)]
+
+  # Configured probability of each rarity per pull, without pity
+  config_rates = [1 - gacha_config["4star_prob"] - gacha_config["5star_prob"], gacha_config["4star_prob"],
+                  gacha_config["5star_prob"], gacha_config["4starup_prob"], gacha_config["5starup_prob"]]
+  config_rates = [esc(f"{rate:.2%}") for rate in config_rates]
+  lines = [
+    "*＊ 抽卡統計 ＊*",
+    f"*＊ 躍遷次數:* {pulls}（{stats.get('sessions', 0)} 場）",
+    f"*＊ 課金次數:* {stats.get('648', 0)}",
+    "",
+    "*稀有度分佈*（實際 / 設定）",
+    f"三星: {ratio(stats.get('3star', 0), pulls)} / {config_rates[0]}",
+    f"四星: {ratio(four_count, pulls)} / {config_rates[1]}",
+    f"五星: {ratio(five_count, pulls)} / {config_rates[2]}",
+    f"四星UP佔比: {ratio(stats.get('4starup', 0), four_count)} / {config_rates[3]}",
+    f"五星UP佔比: {ratio(stats.get('5starup', 0), five_count)} / {config_rates[4]}",
+    "_實際機率包含保底_",
+    "",
+    f"*歐皇榜*（五星率，至少 {gacha_leaderboard_min_pulls} 抽）",
+    *board(tops["luckiest"], lambda score: f"{score:.2%}"),
+    "",
+    f"*非酋榜*（五星率，至少 {gacha_leaderboard_min_pulls} 抽）",
+    *board(tops["unluckiest"], lambda score: f"{-score:.2%}"),
+    "",
+    "*課金榜*",
+    *board(tops["whales"], lambda score: f"{score} 單")
+  ]
+  return "\n".join(lines)
+
+
+async def make_gacha_stats_reply() -> InlineQueryResultArticle:
+  return InlineQueryResultArticle(
+    id=uuid.uuid4().hex,
+    title="抽卡統計",
+    description="看看誰是歐皇",
+    thumbnail_url=bot_pic_url,
+    input_message_content=InputTextMessageContent(await make_gacha_stats_text(), parse_mode=ParseMode.MARKDOWN_V2)
+  )
+
+
+async def handle_gacha_stats(update: Update, context: CallbackContext):
+  await update.message.reply_text(await make_gacha_stats_text(), parse_mode=ParseMode.MARKDOWN_V2, quote=True)
+
+
 async def handle_gacha_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
   user = update.callback_query.from_user
   user_str = user.full_name
@@ -640,10 +1879,12 @@ async def handle_gacha_callback(update: Update, context: ContextTypes.DEFAULT_TY
   # Initate game if it is first run
   if gacha_id is None:
     gacha_id = shortuuid.uuid()[:8]
-    gacha_store[gacha_id] = dict(gacha_init_profile)
-    gacha_store[gacha_id]["owner"] = callback_data["owner"]
-  
-  gacha_data = gacha_store.get(gacha_id)
+    gacha_data = dict(gacha_init_profile, owner=callback_data["owner"], name=user.full_name)
+    await call_shared(gacha_store.__setitem__, gacha_id, gacha_data)
+    gacha_stats["sessions"] += 1
+  else:
+    gacha_data = await call_shared(gacha_store.get, gacha_id)
+
   if gacha_data is None:
     await query.answer("你錯過了本次躍遷活動，請開個新的吧！\n可能本BOT曾經重啟過！", show_alert=True)
     return
@@ -655,6 +1896,7 @@ async def handle_gacha_callback(update: Update, context: ContextTypes.DEFAULT_TY
     case "1pull":
       if gacha_data["balance"] >= 1:
         result = do_gacha(gacha_data)
+        record_gacha_result(result)
         await asyncio.sleep(0)
         gacha_message = f"你抽到了1個{gacha_names[result-3]}"
         if result == Gacha.FIVE or result == Gacha.FIVE_UP:
@@ -669,6 +1911,7 @@ async def handle_gacha_callback(update: Update, context: ContextTypes.DEFAULT_TY
         results = [0, 0, 0, 0, 0]
         for i in range(10):
           result = do_gacha(gacha_data)
+          record_gacha_result(result)
           results[result-3] += 1
           if result == Gacha.FIVE or result == Gacha.FIVE_UP:
             has_5star = True
@@ -689,7 +1932,11 @@ async def handle_gacha_callback(update: Update, context: ContextTypes.DEFAULT_TY
     case "648":
       gacha_data["balance"] += 81
       gacha_data["648_count"] += 1
+      gacha_stats["648"] += 1
       gacha_message = "你忍受不住課金的誘惑，下了一單648！"
+
+  await call_shared(gacha_store.__setitem__, gacha_id, gacha_data)
+  update_gacha_leaderboards(gacha_id, gacha_data)
      
   message = textwrap.dedent(f"""\
       你好，{user_str}
@@ -727,38 +1974,99 @@ async def handle_gacha_callback(update: Update, context: ContextTypes.DEFAULT_TY
     [ 
       InlineKeyboardButton(text="來一單648！", callback_data=json.dumps({"action": "648", "id": gacha_id, "type": "gacha"})),
       InlineKeyboardButton(text="我也試試", switch_inline_query_current_chat=""),
+    ],
+    [
+      InlineKeyboardButton(text="抽卡統計", switch_inline_query_current_chat="g"),
     ]
   ]
 
-  await query.edit_message_text(message, ParseMode.MARKDOWN_V2, reply_markup=InlineKeyboardMarkup(keyboard))
+  # Only the latest state is sent if the previous edit is still waiting for flood limit
+  message_key = callback_message_key(query)
+  send_queue.submit(message_key[0],
+                    lambda: query.edit_message_text(message, ParseMode.MARKDOWN_V2,
+                                                    reply_markup=InlineKeyboardMarkup(keyboard)),
+                    coalesce_key=("edit", *message_key))
 
 async def handle_inline_respond(update: Update, context: CallbackContext):
+  global in_flight_requests
   query = update.inline_query.query.strip()
   user = update.inline_query.from_user
   log.info(
-    f"Received user query #user_id={user.id}, #query=\"{query}\"")
+    "Received user query #user_id=%s, #query=\"%s\"", user.id, query)
+  query_deadline.set(asyncio.get_running_loop().time() + inline_query_deadline)
+
+  if not admit_request(user.id):
+    # Answer from shared results if possible, the superseded query is left running
+    if not await answer_from_memo(update):
+      await update.inline_query.answer(results=[throttled_inline_reply], cache_time=0)
+    return
+
+  # Cancel the in-flight query superseded by this one
+  prev_task = inline_query_tasks.get(user.id)
+  if prev_task is not None and not prev_task.done():
+    prev_task.cancel()
+
+  in_flight_requests += 1
+  task = asyncio.create_task(respond_inline_query(update, context))
+  inline_query_tasks[user.id] = task
+  try:
+    # Wait without propagating the cancellation of `task` to this handler
+    await asyncio.wait([task])
+  finally:
+    in_flight_requests -= 1
+    if not task.done():
+      task.cancel()
+    if inline_query_tasks.get(user.id) is task:
+      del inline_query_tasks[user.id]
+
+  if task.cancelled():
+    log.info("Cancelled superseded user query #user_id=%s, #query=\"%s\"", user.id, query)
+    return
+
+  # Raise the exception from `task` if any
+  task.result()
+
+
+async def respond_inline_query(update: Update, context: CallbackContext):
+  query = update.inline_query.query.strip()
+  user = update.inline_query.from_user
+  memo_key = inline_memo_key(query, update.inline_query.offset)
+  if await answer_from_memo(update):
+    return
+
+  if inline_debounce_delay > 0:
+    await asyncio.sleep(inline_debounce_delay)
+
   if not query:
     reply_quote = quotes[0][random.randint(0, len(quotes[0]) - 1)]
-    reply_image = get_random_pixiv_illust()
     reply_lucky = make_lucky_reply(user, None)
     reply_gacha = make_gacha_reply(user)
-
-    await update.inline_query.answer(results=[
-      reply_image,
+    results = [
       reply_lucky,
       reply_gacha,
       InlineQueryResultArticle(
         id=uuid.uuid4().hex,
         title="生成動漫梗 (0~3個參數)",
         input_message_content=InputTextMessageContent(reply_quote)
-      ), help_inline_reply], cache_time=0)
+      ), help_inline_reply]
+
+    try:
+      results.insert(0, await get_random_pixiv_illust())
+    except asyncio.TimeoutError:
+      # Answer without the illustration rather than too late
+      log.warning("Deadline reached before random illustration is ready #user_id=%s", user.id)
+    except Exception:
+      # Answer the other items rather than nothing
+      log.exception("Failed to get random illustration #user_id=%s", user.id)
+
+    await update.inline_query.answer(results=results, cache_time=0)
 
     return
 
   match query[0]:
     # Get help
     case 'h':
-      await update.inline_query.answer([help_inline_reply], cache_time=3600)
+      await answer_memoized(update, memo_key, [help_inline_reply], cache_time=3600)
 
     # Get quotes
     case 'q':
@@ -776,10 +2084,17 @@ async def handle_inline_respond(update: Update, context: CallbackContext):
           await update.inline_query.answer(results=[help_inline_reply], cache_time=3600)
           return
 
-        city_ids = owm.city_id_registry()
-        locations = city_ids.ids_for(*city_loc, matching="like")
+        city_ids = get_owm().city_id_registry()
+        try:
+          # Local lookup, no need to go through circuit breaker
+          locations = await asyncio.wait_for(asyncio.to_thread(city_ids.ids_for, *city_loc, matching="like"),
+                                             timeout=time_remaining())
+        except asyncio.TimeoutError:
+          await update.inline_query.answer(results=[timeout_inline_reply], cache_time=0)
+          return
+
         log.info(
-          f"Found {len(locations)} locations for #query=\"{query[2:].strip()}\"")
+          "Found %s locations for #query=\"%s\"", len(locations), query[2:].strip())
         # Only not more than 8 results
         if len(locations) == 0:
           await update.inline_query.answer(results=[
@@ -805,31 +2120,60 @@ async def handle_inline_respond(update: Update, context: CallbackContext):
 
           return
 
-        await update.inline_query.answer(await make_owm_reply(locations), cache_time=300, auto_pagination=True)
+        results = await make_owm_reply(locations)
+        # Do not let client cache the partial results
+        await update.inline_query.answer(results, cache_time=0 if deadline_exceeded() else 300, auto_pagination=True)
 
       else:
         await update.inline_query.answer(results=[help_inline_reply], cache_time=3600)
         return
 
+    # Get gacha statistics, other text starting with "g" is for lucky reply
+    case 'g' if query == 'g':
+      await update.inline_query.answer(results=[await make_gacha_stats_reply()], cache_time=30)
+
     case 'r' | 'p':
       if len(query) > 2 and query[1] == ' ':
         try:
           pxid = int(query[2:])
-          results = get_related_pixiv_illust(pxid) if query[0] == 'r' else [make_pixiv_illust_reply(pxid)]
+          if query[0] == 'r':
+            # Fetch the next page only when user scrolls to the end
+            page = int(update.inline_query.offset or "0")
+            if not 0 <= page < max_related_pages:
+              # Offset is not given by the bot
+              await update.inline_query.answer(results=[], cache_time=300, next_offset="")
+              return
+            results, has_next = await get_related_pixiv_illust(pxid, page)
+            if results or page > 0:
+              await answer_memoized(update, memo_key, results=results,
+                                    cache_time=300 if results else inline_negative_cache_time,
+                                    next_offset=str(page + 1) if has_next else "")
+              return
+          else:
+            reply_image = await make_pixiv_illust_reply(pxid)
+            results = [reply_image] if reply_image else []
+
           if results:
-            await update.inline_query.answer(results=results, cache_time=300, auto_pagination=True)
+            await answer_memoized(update, memo_key, results=results, cache_time=300, auto_pagination=True)
           else:
-            await update.inline_query.answer(results=[
+            await answer_memoized(update, memo_key, results=[
               InlineQueryResultArticle(
                 id=uuid.uuid4().hex,
                 title="找不到相關色圖",
                 input_message_content=InputTextMessageContent("沒有結果")
-              )], cache_time=300, auto_pagination=True)
+              )], cache_time=inline_negative_cache_time, auto_pagination=True)
 
         except ValueError:
-          await update.inline_query.answer(results=[help_inline_reply], cache_time=3600)
+          await answer_memoized(update, memo_key, results=[help_inline_reply], cache_time=3600)
           return
 
+        except asyncio.TimeoutError:
+          log.warning("Deadline reached before Pixiv query is done #query=\"%s\"", query)
+          await answer_memoized(update, memo_key, results=[timeout_inline_reply], cache_time=0)
+
+        except UpstreamUnavailable:
+          await answer_memoized(update, memo_key, results=[unavailable_inline_reply], cache_time=0)
+
     case 'm':
       if len(query) > 3 and query[1] == ' ':
         twid: int
@@ -841,14 +2185,22 @@ async def handle_inline_respond(update: Update, context: CallbackContext):
           if matches is not None:
             twid = matches.group(2)
           else:
-            await update.inline_query.answer(results=[help_inline_reply], cache_time=3600)
+            await answer_memoized(update, memo_key, results=[help_inline_reply], cache_time=3600)
             return
 
-        result = make_twi_reply(twid)
+        try:
+          result = await make_twi_reply(twid)
+        except asyncio.TimeoutError:
+          await answer_memoized(update, memo_key, results=[timeout_inline_reply], cache_time=0)
+          return
+        except UpstreamUnavailable:
+          await answer_memoized(update, memo_key, results=[unavailable_inline_reply], cache_time=0)
+          return
+
         if result:
-          await update.inline_query.answer(results=[result], cache_time=3600)
+          await answer_memoized(update, memo_key, results=[result], cache_time=3600)
         else:
-          await update.inline_query.answer(results=[
+          await answer_memoized(update, memo_key, results=[
             InlineQueryResultArticle(
               id=uuid.uuid4().hex,
               title="找不到相關 Tweet",
@@ -856,93 +2208,217 @@ async def handle_inline_respond(update: Update, context: CallbackContext):
             )], cache_time=300)
 
       else:
-        await update.inline_query.answer(results=[help_inline_reply], cache_time=3600)
+        await answer_memoized(update, memo_key, results=[help_inline_reply], cache_time=3600)
 
     case _:
       reply_lucky = make_lucky_reply(user, query)
       await update.inline_query.answer(results=[reply_lucky, help_inline_reply], cache_time=0)
 
 
+# Key of inline results that are same for all users, None if the results depend on user or randomness
+def inline_memo_key(query: str, offset: str) -> str | None:
+  if not query or query[0] not in "prmh":
+    return None
+  return f"{' '.join(query.split())}#{offset}"
+
+
+# Answer inline query with the shared results of other users, return False if there is none
+async def answer_from_memo(update: Update) -> bool:
+  memo_key = inline_memo_key(update.inline_query.query.strip(), update.inline_query.offset)
+  if memo_key is None:
+    return False
+
+  inline_memo_stats["lookups"] += 1
+  memo = inline_memo.get(memo_key)
+  if memo is None:
+    return False
+
+  inline_memo_stats["hits"] += 1
+  results, kwargs = memo
+  await update.inline_query.answer(results, **kwargs)
+  return True
+
+
+# Answer inline query, and share the results of `memo_key` with other users for `cache_time` seconds
+async def answer_memoized(update: Update, memo_key: str | None, results, **kwargs):
+  if memo_key is not None and kwargs.get("cache_time", 0) > 0:
+    inline_memo.set(memo_key, (results, kwargs), ttl=kwargs["cache_time"])
+  await update.inline_query.answer(results, **kwargs)
+
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+  global in_flight_requests
   query = update.callback_query
   callback_data: dict[str, int | str] = json.loads(query.data)
   
   if not "type" in callback_data:
     return
 
-  match callback_data["type"]:
-    case "pixiv":
-      await handle_pixiv_callback(update, context)
-    
-    case "gacha":
-      await handle_gacha_callback(update, context)
+  if not admit_request(query.from_user.id):
+    await query.answer("太快了，休息一下吧～")
+    return
+
+  in_flight_requests += 1
+  try:
+    match callback_data["type"]:
+      case "pixiv":
+        await handle_pixiv_callback(update, context)
+
+      case "gacha":
+        await handle_gacha_callback(update, context)
+  finally:
+    in_flight_requests -= 1
   
 
 # Build quote list from file `path`
 def build_quote_list(*, build_only=False):
-  global quotes, total_quotes_count
   path = Path(file_path["list-acg-quote"])
+  quote_lists = read_quote_list()
   # Download the file if not exist
   if not path.exists() or build_only:
-    quote_list_sources = json.loads(os.getenv('QUOTE_MOEGIRL_LIST'))
-    for url in quote_list_sources:
-      print(f'Processing {url}')
-      response = requests.get(url)
-      # requests may not detect the correct encoding
-      response.encoding = 'UTF-8'
-      soup = BeautifulSoup(response.text, "html5lib")
-      content = soup.find("textarea", {"id": "wpTextbox1"}).text.strip()
-
-      matches = re.findall(r"\[\[(.+?)]]", content)
-      for idx, quote in enumerate(matches[2:]):
-        qs = quote.split('|')
-        result = ""
-        for s in qs:
-          if s and not re.search(r"[/(){}]", s):
-            result = s
-            break
-
-        if not result:
-          continue
-        
-        params = re.findall("(?<![a-zA-Z])(o|x){1,}(?![a-zA-Z])", result)
-        quotes[len(params)].append(result)
-
-    # Build quote list
-    fields = ["quote_text", "param_count"]
-    with open(path, "w") as f:
-      writer = csv.writer(f)
-      writer.writerow(fields)
-      for idx, quote_list in enumerate(quotes):
-        for quote in quote_list:
-          writer.writerow([quote, idx])
+    update_quote_list(path, quote_lists)
 
-  else:
-    # Read from local quote sources
+  data_mtimes["quotes"] = data_file_mtime("list-acg-quote")
+  set_quote_list(quote_lists)
+
+
+# Read quote lists from local quote sources
+def read_quote_list() -> list[list[str]]:
+  quote_lists: list[list[str]] = [[] for x in range(4)]
+  path = Path(file_path["list-acg-quote"])
+  if path.exists():
     with open(path, "r") as f:
       reader = csv.reader(f)
       # Skip header
       next(reader, None)
       for [quote, param_count] in list(reader):
-        quotes[int(param_count)].append(quote)
+        quote_lists[int(param_count)].append(quote)
+
+  return quote_lists
 
+
+# Replace the quote lists as a whole, so that handlers never see a partially built one
+def set_quote_list(quote_lists: list[list[str]]):
+  global quotes, total_quotes_count
+  quotes = quote_lists
   total_quotes_count = len(quotes[0]) + len(quotes[1]) + len(quotes[2])
-  log.info(f"Built ACG quote list with {total_quotes_count} elements")
+  log.info("Built ACG quote list with %s elements", total_quotes_count)
+
+
+# Fetch the quote sources concurrently, merge the new quotes of changed pages into `quote_lists` and `path`
+def update_quote_list(path: Path, quote_lists: list[list[str]]):
+  meta_path = Path(file_path["meta-acg-quote"])
+  # Validators (ETag and Last-Modified) of each source from last build
+  validators: dict[str, dict[str, str | None]] = dict()
+  if path.exists() and meta_path.exists():
+    validators = json.loads(meta_path.read_text())
+
+  quote_list_sources = json.loads(os.getenv('QUOTE_MOEGIRL_LIST'))
+  known_quotes = set(quote for quote_list in quote_lists for quote in quote_list)
+  with ThreadPoolExecutor(max_workers=8) as executor:
+    futures = {executor.submit(fetch_quote_source, url, validators.get(url, {})): url for url in quote_list_sources}
+    for future in as_completed(futures):
+      url = futures[future]
+      try:
+        new_quotes, validators[url] = future.result()
+      except requests.RequestException as e:
+        print(f'Failed to process {url}: {e}')
+        continue
+
+      if new_quotes is None:
+        print(f'Skipped unchanged {url}')
+        continue
+
+      print(f'Processed {url}')
+      for quote in new_quotes:
+        params = re.findall("(?<![a-zA-Z])(o|x){1,}(?![a-zA-Z])", quote)
+        if quote in known_quotes or len(params) >= len(quote_lists):
+          continue
+        known_quotes.add(quote)
+        quote_lists[len(params)].append(quote)
+
+  # Build quote list, replace the old one only when it is completely written
+  fields = ["quote_text", "param_count"]
+  tmp_path = path.with_name(f"{path.name}.tmp")
+  with open(tmp_path, "w") as f:
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    for idx, quote_list in enumerate(quote_lists):
+      for quote in quote_list:
+        writer.writerow([quote, idx])
+  os.replace(tmp_path, path)
+  meta_path.write_text(json.dumps(validators))
+
+
+# Fetch quotes from the wikitext of page `url`
+# Return None if the page is unchanged since it was fetched with `validator`, and the new validator
+def fetch_quote_source(url: str, validator: dict[str, str | None]) -> tuple[list[str] | None, dict[str, str | None]]:
+  headers = dict()
+  if validator.get("etag"):
+    headers["If-None-Match"] = validator["etag"]
+  if validator.get("last_modified"):
+    headers["If-Modified-Since"] = validator["last_modified"]
+
+  response = requests.get(url, headers=headers, timeout=30)
+  if response.status_code == 304:
+    return None, validator
+  response.raise_for_status()
+  # requests may not detect the correct encoding
+  response.encoding = 'UTF-8'
+  # Only the wikitext editor is needed, no need to parse the whole page
+  matches = re.search(r"<textarea[^>]*\bid=\"wpTextbox1\"[^>]*>(.*?)</textarea>", response.text, re.DOTALL)
+  content = html.unescape(matches.group(1)).strip() if matches else ""
+
+  results = []
+  matches = re.findall(r"\[\[(.+?)]]", content)
+  for quote in matches[2:]:
+    qs = quote.split('|')
+    result = ""
+    for s in qs:
+      if s and not re.search(r"[/(){}]", s):
+        result = s
+        break
+
+    if result:
+      results.append(result)
+
+  return results, {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
 
 
 # Fetch the latest user bookmarked ids
-def fetch_latest_bookmarks() -> int:
+async def fetch_latest_bookmarks() -> int:
   global bookmark_ids
+  # Bookmark sync should never delay the interactive queries
+  priority_token = request_priority.set(Priority.BACKGROUND)
+  async with bookmark_sync_lock:
+    try:
+      new_ids = await fetch_new_bookmark_ids()
+    finally:
+      request_priority.reset(priority_token)
+
+    async with data_reload_lock:
+      with open(file_path["list-bookmark-id"], "a") as f:
+        for pxid in reversed(new_ids):
+          bookmark_ids.append(pxid)
+          f.write(f"{pxid}\n")
+      # The list already has the appended ids, no need to reload it
+      data_mtimes["bookmarks"] = data_file_mtime("list-bookmark-id")
+    if new_ids:
+      await publish_data_change("bookmarks")
+
+  return len(new_ids)
+
+
+# Page through user bookmarks until the last known bookmarked id
+async def fetch_new_bookmark_ids() -> list[int]:
   next_qs = {"user_id": os.getenv("PIXIV_USER_ID")}
   should_break = False
   new_ids = []
   while next_qs:
-    result = api.user_bookmarks_illust(**next_qs)
+    result = await call_pixiv("user_bookmarks_illust", **next_qs)
     if not result.illusts:
-      # Refresh token once if failed
-      log.info("Pixiv token may expired, attempt to refresh...")
-      api.auth(refresh_token=os.getenv("PIXIV_AUTH_TOKEN"))
-      result = api.user_bookmarks_illust(**next_qs)
+      log.error("Failed to fetch bookmarks #error=\"%s\"", pixiv_error_message(result))
+      break
 
     for illust in result.illusts:
       # Skip if the illustration not accessible
@@ -958,73 +2434,602 @@ def fetch_latest_bookmarks() -> int:
     if should_break:
       break
 
-    next_qs = api.parse_qs(result.next_url)
-    sleep(random.randint(0, 2))
+    next_qs = parse_pixiv_qs(result.next_url)
 
-  with open(file_path["list-bookmark-id"], "a") as f:
-    for pxid in reversed(new_ids):
-      bookmark_ids.append(pxid)
-      f.write(f"{pxid}\n")
-
-  return len(new_ids)
+  return new_ids
 
 
 # Build Pixiv ids index from file `path`
-def build_pixivid_list():
+def load_pixivid_list():
+  Path(file_path["list-bookmark-id"]).touch(exist_ok=True)
+  data_mtimes["bookmarks"] = data_file_mtime("list-bookmark-id")
+  set_pixivid_list(read_pixivid_list())
+
+
+def read_pixivid_list() -> list[int]:
+  with open(file_path["list-bookmark-id"], "r") as f:
+    # Scan the whole file to build the index
+    return [int(line.rstrip("\n")) for line in f if line.strip()]
+
+
+def set_pixivid_list(ids: list[int]):
   global bookmark_ids
-  path = Path(file_path["list-bookmark-id"])
+  bookmark_ids = ids
+  log.info("Loaded pixiv list with %s elements", len(bookmark_ids))
+
+
+# Fetch bookmarks added since the last run
+async def sync_pixivid_list():
+  started = time.monotonic()
+  try:
+    n = await fetch_latest_bookmarks()
+  except (asyncio.TimeoutError, UpstreamUnavailable) as e:
+    log.error("Failed to sync bookmarks #error=\"%s\"", repr(e))
+    return
+  except Exception:
+    log.exception("Failed to sync bookmarks")
+    return
+
+  log.info("Added %s new elements in %.3fs", n, time.monotonic() - started)
+  log.info("Built pixiv list with %s elements", len(bookmark_ids))
+
+
+async def build_pixivid_list():
+  load_pixivid_list()
+  await sync_pixivid_list()
+
+
+# Build Pixiv file_id index from file `path`
+def build_file_id_list():
+  global pixiv_file_id_offset
+  path = Path(file_path["list-pixiv-file-id"])
   path.touch(exist_ok=True)
-  with open(path, "r") as f:
-    # Scan the whole file to build the index
-    for line in f:
-      bookmark_ids.append(int(line.rstrip("\n")))
+  file_ids, pixiv_file_id_offset = read_file_id_list(0)
+  pixiv_file_ids.update(file_ids)
 
-  n = fetch_latest_bookmarks()
+  log.info("Built Pixiv file_id list with %s elements", len(pixiv_file_ids))
 
-  log.info(f"Added {n} new elements")
-  log.info(f"Built pixiv list with {len(bookmark_ids)} elements")
+
+# Read complete rows of the file_id list after `offset`, return them and the offset after them
+def read_file_id_list(offset: int) -> tuple[dict[tuple[int, int], str], int]:
+  with open(file_path["list-pixiv-file-id"], "rb") as f:
+    f.seek(offset)
+    data = f.read()
+  # The last row may be still being appended
+  end = data.rfind(b"\n") + 1
+  file_ids = dict()
+  for row in csv.reader(data[:end].decode("utf-8", errors="replace").splitlines()):
+    try:
+      [pixiv_id, page, file_id] = row
+      file_ids[(int(pixiv_id), int(page))] = file_id
+    except ValueError:
+      # Row cut short by a crash while appending
+      log.warning("Skipped malformed row of Pixiv file_id list #row=\"%s\"", ",".join(row))
+  return file_ids, offset + end
+
+
+# Load file_ids recorded by other workers since the last load
+async def load_new_file_ids():
+  global pixiv_file_id_offset
+  file_ids, pixiv_file_id_offset = await asyncio.to_thread(read_file_id_list, pixiv_file_id_offset)
+  pixiv_file_ids.update(file_ids)
 
 
 def build_admin_list():
-  path = Path(file_path["list-admin"])
-  path.touch(exist_ok=True)
-  with open(path, "r") as f:
-    for line in f:
-      admins.append(int(line.rstrip("\n")))
+  Path(file_path["list-admin"]).touch(exist_ok=True)
+  data_mtimes["admins"] = data_file_mtime("list-admin")
+  set_admin_list(read_admin_list())
+
+
+def read_admin_list() -> list[int]:
+  with open(file_path["list-admin"], "r") as f:
+    return [int(line.rstrip("\n")) for line in f if line.strip()]
 
+
+def set_admin_list(user_ids: list[int]):
+  global admins
+  admins = user_ids
   if not admins:
     log.warning("No admin exist!")
   else:
-    log.info(f"Found {len(admins)} admins user_ids={admins}")
+    log.info("Found %s admins user_ids=%s", len(admins), admins)
 
 
-def main() -> None:
-  logging.basicConfig(
-    format="%(asctime)s %(levelname)s [%(filename)s:%(lineno)s]: %(funcName)s - %(message)s",
-    level=logging.WARN,
-    datefmt="%Y-%m-%dT%H:%M:%S%z",
-    handlers=[
-      RotatingFileHandler(file_path["log-file"], mode="w+", maxBytes=5 * 1024 * 1024, backupCount=2),
-      logging.StreamHandler()
-    ])
+# Modification time of data file `key`, None if it does not exist
+def data_file_mtime(key: str) -> float | None:
+  try:
+    return os.stat(file_path[key]).st_mtime
+  except FileNotFoundError:
+    return None
+
+
+# Reloadable data, name -> (key of data file, reader, setter)
+# Reader runs in worker thread and builds a new object, setter swaps it in
+reloadable_data = {
+  "quotes": ("list-acg-quote", read_quote_list, set_quote_list),
+  "bookmarks": ("list-bookmark-id", read_pixivid_list, set_pixivid_list),
+  "admins": ("list-admin", read_admin_list, set_admin_list)
+}
+
+
+# Reload data `name` from its file in background thread, the old data is kept if it fails
+async def reload_data(name: str):
+  key, reader, setter = reloadable_data[name]
+  async with data_reload_lock:
+    # Take the mtime before reading, so that a change during reading is picked up next time
+    mtime = data_file_mtime(key)
+    value = await asyncio.to_thread(reader)
+    setter(value)
+    data_mtimes[name] = mtime
+  log.info("Reloaded data #name=%s", name)
+
+
+# Reload data whose file is changed since it was loaded
+async def watch_data_files():
+  while True:
+    await asyncio.sleep(data_reload_interval)
+    mtimes = await asyncio.to_thread(
+      lambda: {name: data_file_mtime(key) for name, (key, _, _) in reloadable_data.items()})
+    for name, mtime in mtimes.items():
+      if mtime is None or mtime == data_mtimes.get(name):
+        continue
+      try:
+        await reload_data(name)
+      except Exception:
+        log.exception("Failed to reload data #name=%s", name)
+        # Retry only when the file is changed again
+        data_mtimes[name] = mtime
+
+
+# Let other workers reload data `name` changed by this worker
+async def publish_data_change(name: str):
+  if data_versions is None:
+    return
+  version = uuid.uuid4().hex
+  loaded_data_versions[name] = version
+  await asyncio.to_thread(data_versions.__setitem__, name, version)
+
+
+# Reload data changed by other workers
+async def sync_data_versions():
+  while True:
+    await asyncio.sleep(data_sync_interval)
+    try:
+      await load_new_file_ids()
+    except OSError as e:
+      log.warning("Failed to load new Pixiv file_ids #error=\"%s\"", repr(e))
+    versions = await asyncio.to_thread(data_versions.copy)
+    for name, version in versions.items():
+      if version == loaded_data_versions.get(name):
+        continue
+      # Retry only when the data is changed again
+      loaded_data_versions[name] = version
+      try:
+        await reload_data(name)
+      except Exception:
+        log.exception("Failed to reload data changed by other worker #name=%s", name)
+
+
+# HTTPXRequest with a configurable keep-alive expiry for pooled connections.
+# Hooks `_build_client`, which is internal to python-telegram-bot: keep its
+# version pinned in requirements.txt
+class KeepAliveHTTPXRequest(HTTPXRequest):
+  def __init__(self, keepalive_expiry: float, connection_pool_size: int = 1, **kwargs):
+    self.limits = httpx.Limits(max_connections=connection_pool_size,
+                               max_keepalive_connections=connection_pool_size,
+                               keepalive_expiry=keepalive_expiry)
+    super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+  def _build_client(self) -> httpx.AsyncClient:
+    return httpx.AsyncClient(**{**self._client_kwargs, "limits": self.limits})
+
+
+def make_tg_request(connection_pool_size: int) -> HTTPXRequest:
+  return KeepAliveHTTPXRequest(
+    keepalive_expiry=tg_keepalive_expiry,
+    connection_pool_size=connection_pool_size,
+    connect_timeout=tg_connect_timeout,
+    read_timeout=tg_read_timeout,
+    write_timeout=tg_write_timeout,
+    pool_timeout=tg_pool_timeout,
+    http_version=tg_http_version
+  )
+
+
+# Run `func` in a worker thread, recording its duration (in seconds) to `timings`
+async def timed_startup_step(timings: dict[str, float], name: str, func, *args):
+  started = time.monotonic()
+  try:
+    await asyncio.to_thread(func, *args)
+  finally:
+    timings[name] = time.monotonic() - started
+
+
+# Most recently used entries of each cache kept in snapshot
+snapshot_cache_entries = 256
+# Snapshot is only saved after restoring the previous one, so that an early shutdown does not overwrite it
+snapshot_restored = False
+
+
+# Snapshot file of this worker
+def snapshot_path() -> Path:
+  path = Path(file_path["snapshot"])
+  if worker_stats is None:
+    return path
+  return path.with_name(f"{bot_id}-snapshot-{worker_index}.json.gz")
+
+
+# Gacha sessions, counters and hot cache entries for warm restart
+async def take_snapshot() -> dict:
+  # Local state is taken in the event loop for a consistent view
+  snapshot = {
+    "time": time.time(),
+    "counters": local_counters(),
+    "illust_cache": illust_cache.dump(snapshot_cache_entries),
+    "related_cache": related_cache.dump(snapshot_cache_entries)
+  }
+  gacha_sessions = await call_shared(gacha_store.copy)
+  snapshot["gacha_store"] = {gacha_id: dict(session) for gacha_id, session in gacha_sessions.items()}
+  return snapshot
+
+
+# Write `snapshot` to `path`, replace the old one only when it is completely written
+def write_snapshot(snapshot: dict, path: Path):
+  tmp_path = path.with_name(f"{path.name}.tmp")
+  with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+    json.dump(snapshot, f, ensure_ascii=False)
+  os.replace(tmp_path, path)
+
+
+def read_snapshot(path: Path) -> dict | None:
+  if not path.exists():
+    return None
+  from pixivpy3.utils import JsonDict
+  with gzip.open(path, "rt", encoding="utf-8") as f:
+    # Pixiv API results are accessed by attribute
+    return json.load(f, object_hook=JsonDict)
+
+
+async def save_snapshot():
+  if not snapshot_restored:
+    return
+  started = time.monotonic()
+  # Written in worker thread
+  snapshot = await take_snapshot()
+  await asyncio.to_thread(write_snapshot, snapshot, snapshot_path())
+  log.info("Saved snapshot in %.3fs #gacha=%s, #illusts=%s, #related=%s", time.monotonic() - started,
+           len(snapshot["gacha_store"]), len(snapshot["illust_cache"]), len(snapshot["related_cache"]))
+
+
+async def save_snapshot_periodically():
+  while True:
+    await asyncio.sleep(snapshot_interval)
+    try:
+      await save_snapshot()
+    except Exception:
+      log.exception("Failed to save snapshot")
+
+
+# Add gacha `sessions` not in the store, in two calls of shared store
+def merge_gacha_sessions(sessions: dict[str, dict[str, int]]):
+  existing = set(gacha_store.keys())
+  gacha_store.update({gacha_id: dict(session) for gacha_id, session in sessions.items() if gacha_id not in existing})
+
+
+# Merge `snapshot` into current state, state changed since start takes precedence
+async def apply_snapshot(snapshot: dict):
+  await call_shared(merge_gacha_sessions, snapshot["gacha_store"])
+  for gacha_id, session in snapshot["gacha_store"].items():
+    # Skip session already pulled after restart, its scores are newer
+    if gacha_session_worker(session) == worker_index and not any(gacha_id in board for board in gacha_leaderboards.values()):
+      update_gacha_leaderboards(gacha_id, session)
+  counters = counter_dicts()
+  for name, values in snapshot["counters"].items():
+    for key, value in values.items():
+      counters[name][key] = counters[name].get(key, 0) + value
+  illust_cache.load(snapshot["illust_cache"])
+  related_cache.load((tuple(key), expiry, tuple(value)) for key, expiry, value in snapshot["related_cache"])
+
+
+# Restore the snapshot saved by last run
+async def restore_snapshot():
+  global snapshot_restored
+  started = time.monotonic()
+  try:
+    snapshot = await asyncio.to_thread(read_snapshot, snapshot_path())
+    if snapshot is not None:
+      await apply_snapshot(snapshot)
+      log.info("Restored snapshot saved at %s in %.3fs #gacha=%s, #illusts=%s, #related=%s",
+               datetime.fromtimestamp(snapshot["time"]).isoformat(), time.monotonic() - started,
+               len(snapshot["gacha_store"]), len(illust_cache), len(related_cache))
+  except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+    log.warning("Failed to restore snapshot #error=\"%s\"", repr(e))
+
+  snapshot_restored = True
+
+
+# Long-running tasks of the bot, cancelled on shutdown
+# Application.stop() waits for tasks from Application.create_task(), which these never finish
+background_tasks: set[asyncio.Task] = set()
+
+
+def start_background_task(coro) -> asyncio.Task:
+  task = asyncio.get_running_loop().create_task(coro)
+  background_tasks.add(task)
+  task.add_done_callback(background_tasks.discard)
+  return task
+
+
+# Run in the event loop of application after it is stopped
+async def post_shutdown(application: Application):
+  for task in background_tasks:
+    task.cancel()
+  await asyncio.gather(*background_tasks, return_exceptions=True)
+  try:
+    await save_snapshot()
+  except Exception:
+    log.exception("Failed to save snapshot")
+
+
+# Run in the event loop of application before polling starts
+# Only the local lists are loaded here, the steps are independent and run concurrently
+async def post_init(application: Application):
+  started = time.monotonic()
+  timings = {}
+  await asyncio.gather(
+    timed_startup_step(timings, "quotes", build_quote_list),
+    timed_startup_step(timings, "admins", build_admin_list),
+    timed_startup_step(timings, "file_ids", build_file_id_list),
+    timed_startup_step(timings, "bookmarks", load_pixivid_list)
+  )
+  breakdown = ", ".join(f"#{name}={duration:.3f}s" for name, duration in timings.items())
+  log.info("Startup finished in %.3fs %s", time.monotonic() - started, breakdown)
+  # Pixiv login and bookmark sync happen after polling starts, by the first worker only
+  if worker_index == 0:
+    start_background_task(sync_pixivid_list())
+  if data_reload_interval > 0:
+    start_background_task(watch_data_files())
+  # Bookmarks synced by the first worker, /reload and file_ids recorded in any worker reach the other workers
+  if data_versions is not None:
+    start_background_task(sync_data_versions())
+  # Warm up from the last run without delaying polling
+  start_background_task(restore_snapshot())
+  if snapshot_interval > 0:
+    start_background_task(save_snapshot_periodically())
+
+
+# Hand over log record to the writer thread as is, so that it is formatted outside the event loop
+class LazyQueueHandler(QueueHandler):
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    return record
+
+
+# Format log record as a JSON line
+class JsonFormatter(logging.Formatter):
+  def format(self, record: logging.LogRecord) -> str:
+    entry = {
+      "time": self.formatTime(record, self.datefmt),
+      "level": record.levelname,
+      "source": f"{record.filename}:{record.lineno}",
+      "func": record.funcName,
+      "message": record.getMessage()
+    }
+    if record.exc_info:
+      entry["exc_info"] = self.formatException(record.exc_info)
+    return json.dumps(entry, ensure_ascii=False)
+
+
+# Route logs through a queue to the file and stream handlers run by a background writer thread
+# With `log_queue` of multiprocessing, records of worker processes are also written
+def setup_logging(log_queue: multiprocessing.Queue | None = None) -> QueueListener:
+  if log_format == "json":
+    formatter = JsonFormatter(datefmt=log_datefmt)
+  else:
+    formatter = logging.Formatter(
+      "%(asctime)s %(levelname)s [%(filename)s:%(lineno)s]: %(funcName)s - %(message)s", datefmt=log_datefmt)
+
+  handlers = [
+    RotatingFileHandler(file_path["log-file"], mode="w+", maxBytes=5 * 1024 * 1024, backupCount=log_backup_count),
+    logging.StreamHandler()
+  ]
+  for handler in handlers:
+    handler.setFormatter(formatter)
+
+  if log_queue is None:
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+  else:
+    # Record must be formatted before being pickled to other process
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+  listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+  logging.basicConfig(level=logging.WARN, handlers=[queue_handler])
   log.setLevel(logging.INFO)
-  log.info(f"Bot {bot_id} is starting")
-  # Build lists
-  build_quote_list()
-  build_pixivid_list()
-  build_admin_list()
-  
-  application = Application.builder().token(token=os.getenv("TG_BOT_API_TOKEN")).build()
+  listener.start()
+  return listener
+
+
+# Send logs of worker process to the writer of front process
+def setup_worker_logging(log_queue: multiprocessing.Queue):
+  queue_handler = QueueHandler(log_queue)
+  queue_handler.setFormatter(logging.Formatter("%(message)s"))
+  logging.basicConfig(level=logging.WARN, handlers=[queue_handler])
+  log.setLevel(logging.INFO)
+
+
+# Build application with handlers, which polls updates itself if `polling`
+def build_application(polling: bool = True) -> Application:
+  builder = Application.builder().token(token=os.getenv("TG_BOT_API_TOKEN")) \
+    .request(make_tg_request(tg_connection_pool_size))
+  if tg_api_base_url:
+    builder = builder.base_url(f"{tg_api_base_url}/bot").base_file_url(f"{tg_api_base_url}/file/bot")
+  if polling:
+    # Outbound calls and polling use separate connection pools, so that replies never wait for get_updates
+    builder = builder.get_updates_request(make_tg_request(tg_polling_pool_size)) \
+      .post_init(post_init).post_shutdown(post_shutdown)
+  else:
+    builder = builder.updater(None)
+  application = builder.build()
   handlers = [
     CommandHandler("bot_log", handle_bot_log),
     CommandHandler("update_bookmarks", handle_update_bookmarks),
-    InlineQueryHandler(handle_inline_respond),
+    CommandHandler("reload", handle_reload),
+    # Inline queries are handled concurrently, so that newer query can cancel the superseded one
+    InlineQueryHandler(handle_inline_respond, block=False),
+    ChosenInlineResultHandler(handle_chosen_inline_result, block=False),
     MessageHandler(filters.COMMAND & (~ filters.UpdateType.EDITED), handle_cmd),
     CallbackQueryHandler(handle_callback_query)
   ]
 
   application.add_handlers(handlers=handlers)
-  application.run_polling(allowed_updates=Update.ALL_TYPES)
+  return application
+
+
+# Worker process for updates with key routed to `index`
+# Updates of a chat go to the same worker, so that its flood limit is enforced by one send queue
+# Updates without chat (inline queries and callbacks of inline messages) are routed by user
+def route_update(update: Update, count: int) -> int:
+  # Bookmarks are synced by the first worker only, so that two workers never append the same ids
+  if update.message is not None and update.message.text and update.message.text.startswith("/update_bookmarks"):
+    return 0
+  if update.effective_chat is not None:
+    key = update.effective_chat.id
+  elif update.effective_user is not None:
+    key = update.effective_user.id
+  else:
+    key = update.update_id
+  return key % count
+
+
+# Poll updates and put them to the queue of worker processes
+async def poll_updates(update_queues: list[multiprocessing.Queue]):
+  bot = Bot(token=os.getenv("TG_BOT_API_TOKEN"),
+            base_url=f"{tg_api_base_url}/bot" if tg_api_base_url else "https://api.telegram.org/bot",
+            base_file_url=f"{tg_api_base_url}/file/bot" if tg_api_base_url else "https://api.telegram.org/file/bot",
+            request=make_tg_request(1), get_updates_request=make_tg_request(tg_polling_pool_size))
+  async with bot:
+    await bot.delete_webhook()
+    offset = None
+    while True:
+      try:
+        updates = await bot.get_updates(offset=offset, timeout=tg_polling_timeout, allowed_updates=Update.ALL_TYPES)
+      except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        continue
+      except TelegramError as e:
+        log.warning("Failed to get updates #error=\"%s\"", repr(e))
+        await asyncio.sleep(1)
+        continue
+
+      for update in updates:
+        offset = update.update_id + 1
+        update_queues[route_update(update, len(update_queues))].put(update.to_dict())
+
+
+# Next update from the front process, None if it is stopped
+def next_update(update_queue: multiprocessing.Queue) -> dict | None:
+  while True:
+    try:
+      return update_queue.get(timeout=1)
+    except queue.Empty:
+      if not multiprocessing.parent_process().is_alive():
+        return None
+
+
+# Process updates from the front process until it is stopped
+async def serve_updates(update_queue: multiprocessing.Queue):
+  application = build_application(polling=False)
+  async with application:
+    await post_init(application)
+    await application.start()
+    start_background_task(publish_counters())
+    while (data := await asyncio.to_thread(next_update, update_queue)) is not None:
+      await application.update_queue.put(Update.de_json(data, application.bot))
+    await application.stop()
+    await post_shutdown(application)
+
+
+def run_worker(index: int, count: int, update_queue: multiprocessing.Queue, shared_gacha_store, shared_worker_stats,
+               shared_data_versions, log_queue: multiprocessing.Queue, log_path: str, front_start_time: datetime):
+  global worker_index, gacha_store, worker_stats, data_versions, start_time, pixiv_scheduler, send_queue
+  # Shutdown is coordinated by the front process
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  setup_worker_logging(log_queue)
+  worker_index = index
+  gacha_store = shared_gacha_store
+  worker_stats = shared_worker_stats
+  data_versions = shared_data_versions
+  start_time = front_start_time
+  file_path["log-file"] = log_path
+  # Pixiv rate limit is shared by all workers
+  pixiv_scheduler = PixivScheduler(pixiv_rate_limit * len(pixiv_refresh_tokens) / count,
+                                   max(pixiv_rate_burst * len(pixiv_refresh_tokens) // count, 2))
+  # So is the global Bot API rate limit
+  send_queue = TelegramSendQueue(global_rate=send_queue.global_bucket.rate / count)
+  log.info("Worker %s is starting", index)
+  asyncio.run(serve_updates(update_queue))
+  log.info("Worker %s is stopped", index)
+
+
+def raise_interrupt(signum, frame):
+  raise KeyboardInterrupt
+
+
+# Poll updates in this process and distribute them to `bot_workers` worker processes
+def main_multi_worker(log_listener: QueueListener, log_queue: multiprocessing.Queue):
+  # Build the quote list once instead of by every worker
+  if not Path(file_path["list-acg-quote"]).exists():
+    build_quote_list()
+  context = multiprocessing.get_context("spawn")
+  manager = SyncManager(ctx=context)
+  # Keep the shared store alive until all workers are stopped
+  manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+  shared_gacha_store = manager.dict()
+  shared_worker_stats = manager.dict()
+  shared_data_versions = manager.dict()
+  update_queues = [context.Queue() for _ in range(bot_workers)]
+  workers = [
+    context.Process(target=run_worker, name=f"worker-{idx}",
+                    args=(idx, bot_workers, update_queues[idx], shared_gacha_store, shared_worker_stats,
+                          shared_data_versions, log_queue, file_path["log-file"], start_time))
+    for idx in range(bot_workers)
+  ]
+  for worker in workers:
+    worker.start()
+
+  signal.signal(signal.SIGTERM, raise_interrupt)
+  try:
+    asyncio.run(poll_updates(update_queues))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    log.info("Stopping %s workers", bot_workers)
+    for update_queue in update_queues:
+      update_queue.put(None)
+    for worker in workers:
+      worker.join(timeout=10)
+      if worker.is_alive():
+        worker.terminate()
+    manager.shutdown()
+    log_listener.stop()
+
+
+def main() -> None:
+  if bot_workers > 1:
+    log_queue = multiprocessing.get_context("spawn").Queue()
+    log_listener = setup_logging(log_queue)
+    log.info("Bot %s is starting with %s workers", bot_id, bot_workers)
+    main_multi_worker(log_listener, log_queue)
+    return
+
+  log_listener = setup_logging()
+  log.info("Bot %s is starting", bot_id)
+  application = build_application()
+  try:
+    application.run_polling(allowed_updates=Update.ALL_TYPES, timeout=tg_polling_timeout)
+  finally:
+    # Flush the pending logs
+    log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -1034,7 +3039,7 @@ if __name__ == '__main__':
   build_quote_parser = subparsers.add_parser("build_quote")
   build_quote_parser.set_defaults(func=lambda _: build_quote_list(build_only=True))
   build_bookmarks_parser = subparsers.add_parser("build_bookmarks")
-  build_bookmarks_parser.set_defaults(func=lambda _: build_pixivid_list())
+  build_bookmarks_parser.set_defaults(func=lambda _: asyncio.run(build_pixivid_list()))
   help_parser = subparsers.add_parser("help")
   help_parser.set_defaults(func=lambda _: parser.print_usage())
   args = parser.parse_args()